@@ -6,6 +6,7 @@ import os
 
 from flask import Flask, render_template, make_response, jsonify
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from code.settings import ProdConfig, DevConfig
 from code.extensions import (
@@ -13,7 +14,18 @@ from code.extensions import (
     migrate,
     mail,
 )
+from code.database import configure_indexes
+from code.metrics import metrics
+from code.pool import db_pool
+from code.querybudget import query_budget
+from code.revocation import revocations
+from code.cache import count_cache, response_cache
+from code.compression import compression
+from code.passwords import passwords
+from code.ratelimit import rate_limiter
+from code.mailer import mailer
 from code.api import api_blueprint
+from code.commands import tokens_cli, data_cli, mail_cli
 
 if os.getenv("FLASK_ENV") == 'prod':
     DefaultConfig = ProdConfig
@@ -36,22 +48,52 @@ def create_app(config_object=DefaultConfig):
         return render_template('index.html', title='Home')
     # Enabling cors
     CORS(app)
+    register_proxy_fix(app)
     register_extensions(app)
     register_blueprints(app)
+    register_commands(app)
     error_handlers(app)
     from code.models.user import User
     return app
 
 
+def register_proxy_fix(app):
+    """ Takes the client address and scheme from the headers of the trusted
+    proxies, which rate limits key on.
+    """
+    x_for = app.config.get('PROXY_FIX_X_FOR', 0)
+    x_proto = app.config.get('PROXY_FIX_X_PROTO', 0)
+    if x_for or x_proto:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=x_for, x_proto=x_proto)
+
+
 def register_extensions(app):
+    metrics.init_app(app)
+    query_budget.init_app(app)
+    db_pool.init_app(app)
     db.init_app(app)
+    configure_indexes(app)
     migrate.init_app(app, db)
     mail.init_app(app)
+    revocations.init_app(app)
+    count_cache.init_app(app)
+    response_cache.init_app(app)
+    compression.init_app(app)
+    passwords.init_app(app)
+    rate_limiter.init_app(app)
+    mailer.init_app(app)
+    db_pool.warm(app)
 
 
 def register_blueprints(app):
     app.register_blueprint(api_blueprint)
 
+
+def register_commands(app):
+    app.cli.add_command(tokens_cli)
+    app.cli.add_command(data_cli)
+    app.cli.add_command(mail_cli)
+
 def error_handlers(app):
     @app.errorhandler(404)
     def not_found(error):
@@ -3,8 +3,11 @@
 from flask import Blueprint
 from flask_restful import Api, fields
 
+from code.serializers import output_json
+
 api_blueprint = Blueprint("api", __name__, url_prefix='/api')
 api = Api(api_blueprint)
+api.representation('application/json')(output_json)
 
 # Marshaled fields for links in meta section
 link_fields = {
@@ -15,11 +18,14 @@ link_fields = {
 }
 
 # Marshaled fields for meta section
+# (page, total and pages are null for cursor pages)
 meta_fields = {
-    'page': fields.Integer,
+    'page': fields.Integer(default=None),
     'limit': fields.Integer,
-    'total': fields.Integer,
-    'pages': fields.Integer,
+    'total': fields.Integer(default=None),
+    'pages': fields.Integer(default=None),
+    # Whether total and pages are exact rather than estimated
+    'exact': fields.Boolean(default=None),
     'links': fields.Nested(link_fields)
 }
 
@@ -29,3 +35,5 @@ from . import user  # NOQA
 from . import category  # NOQA
 from . import recipe  # NOQA
 from . import auth  # NOQA
+from . import archive  # NOQA
+from . import stats  # NOQA
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import json
+from flask import Response, abort, g, request, stream_with_context
+from flask_restful import Resource
+
+from code.api import api
+from code.api.auth import self_only, token_required, ensure_auth_header
+from code.api.category import category_fields
+from code.api.recipe import recipe_fields
+from code.extensions import db
+from code.helpers import abort_on_conflict
+from code.importer import READERS, import_records
+from code.models.category import Category
+from code.models.recipe import Recipe
+from code.serializers import compile_fields
+
+# Rows fetched per round trip by the export cursor
+EXPORT_BATCH_SIZE = 500
+
+serialize_category = compile_fields(category_fields)
+serialize_recipe = compile_fields(recipe_fields)
+
+# Import formats by request content type
+IMPORT_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'text/csv': 'csv',
+}
+
+
+def export_rows(user_id):
+    """ Streams (category, recipe) pairs of a user through a server-side
+    cursor, grouped by category; recipe is None for empty categories.
+    """
+    return db.session.query(Category, Recipe) \
+        .outerjoin(Recipe, Recipe.category_id == Category.id) \
+        .filter(Category.user_id == user_id) \
+        .order_by(Category.id, Recipe.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_lines(rows):
+    """ One NDJSON line per category, with its recipes nested. """
+    current = None
+    for category, recipe in rows:
+        if current is None or current['id'] != category.id:
+            if current is not None:
+                yield json.dumps(current) + '\n'
+            current = serialize_category(category)
+            current['recipes'] = []
+        if recipe is not None:
+            current['recipes'].append(serialize_recipe(recipe))
+    if current is not None:
+        yield json.dumps(current) + '\n'
+
+
+class ExportResource(Resource):
+    """ Resource that exports a user's categories and recipes """
+    @ensure_auth_header
+    @token_required
+    @self_only
+    def get(self, current_user, user_id=None, username=None):
+        """ Streams every category with its recipes as NDJSON """
+        body = export_lines(export_rows(g.user.id))
+        return Response(stream_with_context(body), mimetype='application/x-ndjson')
+
+
+class ImportResource(Resource):
+    """ Resource that imports categories and recipes for a user """
+    @ensure_auth_header
+    @token_required
+    @self_only
+    def post(self, current_user, user_id=None, username=None):
+        """ Merges an NDJSON or CSV recipe book into the user's categories """
+        format = IMPORT_FORMATS.get(request.mimetype)
+        if format is None:
+            abort(415, {"message" : "Send application/x-ndjson or text/csv."})
+        records = READERS[format](request.stream)
+        with abort_on_conflict("Titles were taken while importing. Please retry."):
+            return import_records(g.user.id, records), 200
+
+
+api.add_resource(ExportResource, '/users/<int:user_id>/export', '/users/<username>/export')
+api.add_resource(ImportResource, '/users/<int:user_id>/import', '/users/<username>/import')
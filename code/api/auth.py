@@ -2,20 +2,35 @@
 
 import functools
 from functools import wraps
-from flask import g, abort, request, make_response, jsonify
+from flask import g, abort, current_app, request, make_response, jsonify
 from code.models.user import User
 from code.models.category import Category
 from code.models.recipe import Recipe
+from code.revocation import revocations
+from code.database import remember, recall
+from sqlalchemy.orm import contains_eager
 
 def self_only(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         measure_user(**kwargs)
+        preload_recipe(**kwargs)
         measure_category(**kwargs)
         measure_recipe(**kwargs)
         return func(*args, **kwargs)
     return wrapper
 
+def preload_recipe(**kwargs):
+    """
+    Loads a recipe together with its category in one query and keeps both
+    for the rest of the request, so ownership checks and handlers reuse them
+    """
+    if kwargs.get('recipe_id', None) and not recall(Recipe, kwargs['recipe_id']):
+        recipe = Recipe.query.join(Recipe.category).options(contains_eager(Recipe.category)) \
+            .filter(Recipe.id == kwargs['recipe_id']).first()
+        if recipe:
+            remember(recipe, recipe.category)
+
 def measure_user(**kwargs):
     if kwargs.get('username', None):
         if g.user.username != kwargs['username']:
@@ -53,6 +68,40 @@ def ensure_auth_header(func):
         return func(*args, **kwargs)
     return wrapper
 
+class UserProxy(object):
+    """
+    Stand-in for ``g.user`` built from the token claims. The ``User`` row is
+    only loaded once a handler touches state the token does not carry.
+    """
+    def __init__(self, claims):
+        self.id = claims['sub']
+        self.username = claims['username']
+        self._user = None
+
+    def _get_current_object(self):
+        if self._user is None:
+            self._user = User.get_by_id(self.id)
+            if self._user is None:
+                abort(401, { 'message': "Integrity credentials for provided token are lacking." })
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+
+def stateless_user(claims):
+    """
+    Returns a ``UserProxy`` when the request may skip loading the user
+    """
+    if not current_app.config['AUTH_STATELESS'] or request.method not in ('GET', 'HEAD'):
+        return None
+    if 'ver' not in claims or 'username' not in claims:
+        return None
+    if revocations.credential_version(claims['sub']) != claims['ver']:
+        return None
+    return UserProxy(claims)
+
+
 def token_required(f):
     """
     Decorator function to ensure that a resource is access by only authenticated users
@@ -68,11 +117,23 @@ def token_required(f):
                 return make_response(jsonify({ 'message': 'Provide a valid auth token' }), 403)
         if not token:
             return make_response(jsonify({ 'message': 'Token is missing' }), 401)
+        decode_response = None
         try:
-            decode_response = User.decode_auth_token(token)
-            current_user = User.query.filter_by(id=decode_response).first()
+            decode_response = User.decode_auth_claims(token)
+            if isinstance(decode_response, str):
+                return make_response(jsonify({ 'status': 'Failed', 'message': decode_response}), 401)
+            current_user = stateless_user(decode_response)
+            if current_user is None:
+                current_user = User.query.filter_by(id=decode_response['sub']).first()
+                # Stateless mode honours tokens without loading the user, so
+                # password changes end every session through the version
+                if current_user and current_app.config['AUTH_STATELESS'] \
+                        and decode_response.get('ver', 0) != current_user.credential_version:
+                    return make_response(jsonify({ 'status': 'Failed', 'message': 'Revoked token. Please sign in again.'}), 401)
             if current_user:
                 g.user = current_user
+                if isinstance(current_user, User):
+                    remember(current_user)
             else:
                 return make_response(jsonify({ 'message': "Integrity credentials for provided token are lacking." }), 401)
         except:
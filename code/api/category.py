@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import re
-from flask import abort, g
-from flask_restful import Resource, reqparse, marshal_with, fields
+from flask import abort, g, request
+from flask_restful import Resource, reqparse, fields
 
 from code.api import api, meta_fields
 from code.api.auth import self_only, token_required, ensure_auth_header
+from code.api.recipe import recipe_fields
 from code.models.category import Category
-from code.models.user import User
-from code.helpers import paginate, abort_if_exists, validate_json
+from code.serializers import serialize_with
+from code.replicas import read_from_replica
+from code.helpers import (paginate, cache_response, conditional, embed, abort_on_conflict,
+                          create_batch, bulk_selection, bulk_values, validate_json)
 
 def valid_str(value, name):
     if ' ' in value:
@@ -21,6 +24,7 @@ category_parser.add_argument('title', type=str)
 category_parser.add_argument('description', type=str)
 category_collection_parser = reqparse.RequestParser()
 category_collection_parser.add_argument('title', type=str)
+category_collection_parser.add_argument('q', type=str)
 
 
 # Marshaled field definitions for category objects
@@ -33,6 +37,11 @@ category_fields = {
     'modified_at' : fields.DateTime
 }
 
+# Children that can be embedded in category objects with ?include=
+category_includes = {
+    'recipes': fields.List(fields.Nested(recipe_fields), attribute='included_recipes'),
+}
+
 # Marshaled field definitions for collections of category objects
 category_collection_fields = {
     'items': fields.List(fields.Nested(category_fields)),
@@ -45,7 +54,9 @@ class CategoryResource(Resource):
     @ensure_auth_header
     @token_required
     @self_only
-    @marshal_with(category_fields)
+    @serialize_with(category_fields, include=category_includes)
+    @conditional
+    @embed(recipes=Category.include_recipes)
     def get(self, current_user, user_id=None, category_id=0, **kwargs):
         """ Resource that gets a category by id"""
         category = Category.get_by_id(category_id)
@@ -57,17 +68,17 @@ class CategoryResource(Resource):
     @token_required
     @self_only
     @validate_json
-    @marshal_with(category_fields)
+    @serialize_with(category_fields)
     def put(self, current_user, user_id=None, category_id=0, **kwargs):
         """ Resource that updates a category by id"""
         category = Category.get_by_id(category_id)
         args = category_parser.parse_args()
-        abort_if_exists(g.user.id, category_name=args['title'])
 
         if not category:
             abort(404, { "message": "Category does not exist" })
 
-        category.update(**category_parser.parse_args())
+        with abort_on_conflict("Category already exists"):
+            category.update(**args)
         return category
 
     @ensure_auth_header
@@ -94,27 +105,27 @@ class CategoryCollectionResource(Resource):
     @ensure_auth_header
     @token_required
     @self_only
-    @marshal_with(category_collection_fields)
-    @paginate()
+    @read_from_replica
+    @cache_response
+    @serialize_with(category_collection_fields, include=category_includes)
+    @conditional
+    @embed(recipes=Category.include_recipes)
+    @paginate(count='cached')
     def get(self, current_user, user_id=None, username=None, title=None):
         """ Resource that gets a list of categories """
-        # Find user that category goes with
-        user = None
-        if user_id:
-            user = User.get_by_id(user_id)
-        else:
-            user = User.get_by_username(username)
-
-        if not user:
-            abort(404, { "message": "User does not exist" })
+        # self_only has matched the user that category goes with
+        user = g.user
 
         # Get the user's categories
         categories = Category.query.filter_by(user_id=user.id)
 
         args = category_collection_parser.parse_args()
+        # ranked full-text search over titles and descriptions
+        if args['q']:
+            categories = Category.search(categories, args['q'])
         # fancy url argument query filtering!
         if args['title'] is not None:
-            categories = Category.query.filter(Category.title.ilike(
+            categories = categories.filter(Category.title.ilike(
                 '%' + args['title'] + '%')).filter(Category.user_id == g.user.id)
         if not categories:
             abort(404, { "message": "No categories to display." })
@@ -125,18 +136,59 @@ class CategoryCollectionResource(Resource):
     @token_required
     @self_only
     @validate_json
-    @marshal_with(category_fields)
+    @serialize_with(category_fields)
     def post(self, current_user, user_id=None, username=None):
         """ Resource that creates a new category """
         args = category_parser.parse_args()
-        abort_if_exists(g.user.id, category_name=args['title'])
         # user owns the category
         args['user_id'] = g.user.id
-        category = Category.create(**args)
+        with abort_on_conflict("Category already exists"):
+            category = Category.create(**args)
         return category, 201
 
+    @ensure_auth_header
+    @token_required
+    @self_only
+    @validate_json
+    def patch(self, current_user, user_id=None, username=None):
+        """ Resource that updates the categories picked by ids or title filter """
+        values = bulk_values(Category, 'description')
+        count = Category.bulk_update(bulk_selection(Category, g.user.id), values, owner=g.user.id)
+        result = {
+            'status': 'Updated',
+            'message': 'Categories updated successfully',
+            'count': count
+        }
+        return result
+
+    @ensure_auth_header
+    @token_required
+    @self_only
+    def delete(self, current_user, user_id=None, username=None):
+        """ Resource that deletes the categories picked by ids or title filter """
+        count = Category.bulk_delete(bulk_selection(Category, g.user.id), owner=g.user.id)
+        result = {
+            'status': 'Deleted',
+            'message': 'Categories deleted successfully',
+            'count': count
+        }
+        return result
+
+
+class CategoryBatchResource(Resource):
+    """ Resource that creates many categories at once """
+    @ensure_auth_header
+    @token_required
+    @self_only
+    @validate_json
+    def post(self, current_user, user_id=None, username=None):
+        """ Resource that creates a batch of categories in one transaction """
+        return create_batch(Category, g.user.id, request.get_json(), "Category already exists")
+
 
 api.add_resource(CategoryResource, '/users/<int:user_id>/categories/<int:category_id>',
                  '/users/<username>/categories/<int:category_id>')
 api.add_resource(CategoryCollectionResource, '/users/<int:user_id>/categories',
                  '/users/<username>/categories')
+api.add_resource(CategoryBatchResource, '/users/<int:user_id>/categories/batch',
+                 '/users/<username>/categories/batch')
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import re
-from flask import abort, g
-from flask_restful import Resource, reqparse, marshal_with, fields
+from flask import abort, g, request
+from flask_restful import Resource, reqparse, fields
 
 from code.api import api, meta_fields
 from code.api.auth import self_only, token_required, ensure_auth_header
 from code.models.recipe import Recipe
+from code.serializers import serialize_with
+from code.replicas import read_from_replica
 from code.models.category import Category
-from code.helpers import paginate, abort_if_exists, validate_json
+from code.helpers import (paginate, cache_response, conditional, abort_on_conflict,
+                          create_batch, bulk_selection, bulk_values, validate_json)
 
 def valid_str(value, name):
     if ' ' in value:
@@ -23,6 +26,7 @@ recipe_parser.add_argument('category_id', type=int)
 
 recipe_collection_parser = reqparse.RequestParser()
 recipe_collection_parser.add_argument('title', type=str)
+recipe_collection_parser.add_argument('q', type=str)
 
 
 # Marshaled field definitions for recipe objects
@@ -47,7 +51,8 @@ class RecipeResource(Resource):
     @ensure_auth_header
     @token_required
     @self_only
-    @marshal_with(recipe_fields)
+    @serialize_with(recipe_fields)
+    @conditional
     def get(self, current_user, category_id=None, recipe_id=0, **kwargs):
         """ Resource that gets a recipe by id """
         recipe = Recipe.get_by_id(recipe_id)
@@ -61,20 +66,19 @@ class RecipeResource(Resource):
     @token_required
     @self_only
     @validate_json
-    @marshal_with(recipe_fields)
+    @serialize_with(recipe_fields)
     def put(self, current_user, category_id=None, recipe_id=0, **kwargs):
         """ Resource that updates a recipe by id """
         args = recipe_parser.parse_args()
         recipe = Recipe.get_by_id(recipe_id)
         if args['category_id'] != category_id:
             abort(404, { "message" : "Provide valid category id." })
-        # abort if recipe exists
-        abort_if_exists(g.user.id, category_id=category_id, recipe_name=args['title'])
 
         if not recipe:
             abort(404, { "message" : "Recipe does not exist." })
 
-        recipe.update(**recipe_parser.parse_args())
+        with abort_on_conflict("Recipe already exists"):
+            recipe.update(**args)
         return recipe
 
     @ensure_auth_header
@@ -101,8 +105,11 @@ class RecipeCollectionResource(Resource):
     @ensure_auth_header
     @token_required
     @self_only
-    @marshal_with(recipe_collection_fields)
-    @paginate()
+    @read_from_replica
+    @cache_response
+    @serialize_with(recipe_collection_fields)
+    @conditional
+    @paginate(count='cached')
     def get(self, current_user, category_id=None, title=None):
         """ Resource that gets a list of recipes """
         # Find category that recipe goes with
@@ -110,7 +117,7 @@ class RecipeCollectionResource(Resource):
         if category_id:
             category = Category.get_by_id(category_id)
         else:
-            category = Category.get_by_title(title)
+            category = Category.get_by_title(title, g.user.id)
 
         if not category:
             abort(404, { "message" : "Category does not exist." })
@@ -119,9 +126,12 @@ class RecipeCollectionResource(Resource):
         recipes = Recipe.query.filter_by(category_id=category.id)
 
         args = recipe_collection_parser.parse_args()
+        # ranked full-text search over titles and descriptions
+        if args['q']:
+            recipes = Recipe.search(recipes, args['q'])
         # fancy url argument query filtering!
         if args['title'] is not None:
-            recipes = Recipe.query.filter(Recipe.title.ilike(
+            recipes = recipes.filter(Recipe.title.ilike(
                 '%' + args['title'] + '%')).filter(Recipe.category_id == category.id)
         if not recipes:
             abort(404, { "message": "No recipes to display." })
@@ -132,7 +142,7 @@ class RecipeCollectionResource(Resource):
     @token_required
     @self_only
     @validate_json
-    @marshal_with(recipe_fields)
+    @serialize_with(recipe_fields)
     def post(self, current_user, category_id=None, title=None):
         """ Resource that creates a new recipe """
         args = recipe_parser.parse_args()
@@ -142,13 +152,65 @@ class RecipeCollectionResource(Resource):
         category = Category.get_by_id(category_id)
         if not category:
             abort(404, { "message" : "Category does not exist." })
-        # abort if recipe exists
-        abort_if_exists(g.user.id, category_id=category_id, recipe_name=args['title'])
-        recipe = Recipe.create(**args)
+        with abort_on_conflict("Recipe already exists"):
+            recipe = Recipe.create(**args)
         return recipe, 201
 
+    @ensure_auth_header
+    @token_required
+    @self_only
+    @validate_json
+    def patch(self, current_user, category_id=None, title=None):
+        """ Resource that updates the recipes picked by ids or title filter """
+        category = owned_category(category_id, title)
+        values = bulk_values(Recipe, 'description')
+        count = Recipe.bulk_update(bulk_selection(Recipe, category.id), values, owner=category.id)
+        result = {
+            'status': 'Updated',
+            'message': 'Recipes updated successfully',
+            'count': count
+        }
+        return result
+
+    @ensure_auth_header
+    @token_required
+    @self_only
+    def delete(self, current_user, category_id=None, title=None):
+        """ Resource that deletes the recipes picked by ids or title filter """
+        category = owned_category(category_id, title)
+        count = Recipe.bulk_delete(bulk_selection(Recipe, category.id), owner=category.id)
+        result = {
+            'status': 'Deleted',
+            'message': 'Recipes deleted successfully',
+            'count': count
+        }
+        return result
+
+
+def owned_category(category_id=None, title=None):
+    """ Category of a collection route, which must belong to the current user """
+    if category_id:
+        category = Category.get_by_id(category_id)
+    else:
+        category = Category.get_by_title(title, g.user.id)
+    if not category or category.user_id != g.user.id:
+        abort(404, { "message" : "Category does not exist." })
+    return category
+
+
+class RecipeBatchResource(Resource):
+    """ Resource that creates many recipes at once """
+    @ensure_auth_header
+    @token_required
+    @self_only
+    @validate_json
+    def post(self, current_user, category_id=None):
+        """ Resource that creates a batch of recipes in one transaction """
+        return create_batch(Recipe, category_id, request.get_json(), "Recipe already exists")
+
 
 api.add_resource(RecipeResource, '/categories/<int:category_id>/recipes/<int:recipe_id>',
                  '/categories/<title>/recipes/<int:recipe_id>')
 api.add_resource(RecipeCollectionResource, '/categories/<int:category_id>/recipes',
                  '/categories/<title>/recipes')
+api.add_resource(RecipeBatchResource, '/categories/<int:category_id>/recipes/batch')
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+import os
+from flask import current_app
+from flask_restful import Resource
+
+from code.api import api
+from code.pool import db_pool
+from code.api.auth import token_required, ensure_auth_header
+
+
+class StatsResource(Resource):
+    """ Resource that reports the caches' and the pool's counters """
+    @ensure_auth_header
+    @token_required
+    def get(self, current_user):
+        """ Entries, hits and misses of each cache, and connection pool
+        usage, in this worker """
+        result = { 'pid': os.getpid() }
+        for name in ('response_cache', 'count_cache'):
+            cache = current_app.extensions.get(name)
+            result[name] = cache.stats() if cache is not None else None
+        result['db_pool'] = db_pool.stats()
+        return result, 200
+
+
+api.add_resource(StatsResource, '/stats')
@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 import re
-from flask import abort, current_app, g
-from flask_restful import Resource, reqparse, marshal_with, fields
-from flask_mail import Message
+from flask import abort, g
+from flask_restful import Resource, reqparse, fields
 
 # Module imports
-from code import mail
+from code.mailer import mailer
 from code.api import api, meta_fields
 from code.api.auth import self_only, token_required, ensure_auth_header
 from code.models.user import User
-from code.models.token import Token
+from code.serializers import serialize_with
+from code.replicas import read_from_replica
+from code.revocation import revocations
 from code.helpers import paginate, validate_json
+from code.ratelimit import rate_limited
 
 def valid_str(value, name):
     if ' ' in value:
@@ -70,7 +72,7 @@ class UserResource(Resource):
     @ensure_auth_header
     @token_required
     @self_only
-    @marshal_with(user_fields)
+    @serialize_with(user_fields)
     def get(self, current_user, user_id=None, username=None):
         """ Resource that gets a user by id"""
         user = None
@@ -89,7 +91,7 @@ class UserResource(Resource):
     @token_required
     @self_only
     @validate_json
-    @marshal_with(user_fields)
+    @serialize_with(user_fields)
     def put(self, current_user, user_id=None, username=None):
         """ Resource that updates a user by id"""
         g.user.update(**user_parser.parse_args())
@@ -109,13 +111,15 @@ class UserResource(Resource):
 
 class UserCollectionResource(Resource):
     """ Resource that gets a list of users and creates a new user """
-    @marshal_with(user_collection_fields)
-    @paginate()
+    @read_from_replica
+    @serialize_with(user_collection_fields)
+    @paginate(count='estimated')
     def get(self):
         """ Resource that gets a list of users"""
         users = User.query
         return users
     
+    @rate_limited
     @validate_json
     def post(self):
         """ Resource that creates a new user """
@@ -146,6 +150,7 @@ class UserCollectionResource(Resource):
 
 class UserSigninResource(Resource):
     """ Resource that signs in a user """
+    @rate_limited
     @validate_json
     def post(self):
         """ Resource that signs in a user """
@@ -156,6 +161,8 @@ class UserSigninResource(Resource):
         if re.match(r"[^@]+@[^@]+\.[^@]+", email) and len(password) > 6:
             user = User.get_by_email(email)
             if user and user.check_password(password):
+                if user.upgrade_password_hash(password):
+                    user.save()
                 token = user.encode_auth_token(user.id)
                 result = { 'message': 'User has signed in successfully.', 'token' : token.decode("utf-8"), 'userid': user.id }
                 return result, 200
@@ -183,10 +190,9 @@ class UserSignoutResource(Resource):
                 result = { 'message': 'Provide a valid authentication token' }
                 return result, 403
             else:
-                decoded_token_response = User.decode_auth_token(auth_token)
+                decoded_token_response = User.decode_auth_claims(auth_token)
                 if not isinstance(decoded_token_response, str):
-                    token = Token(auth_token)
-                    token.save()
+                    revocations.revoke(decoded_token_response, auth_token)
                     result = { 'message': 'Successfully logged out' }
                     return result, 200
                 result = { 'message': decoded_token_response }
@@ -198,6 +204,7 @@ class UserSignoutResource(Resource):
 # Sends Recovery Email
 class UserSendRecoveryResource(Resource):
     """ Resource that sends a user a recovery email """
+    @rate_limited
     @validate_json
     def post(self):
         """
@@ -212,22 +219,19 @@ class UserSendRecoveryResource(Resource):
                 token = user.encode_recovery_token(recovery_email)
                 recovery_token = token.decode("utf-8")
                 recover_url = api.url_for(UserPasswordResetResource, token=token, _external=True)
-                try:
-                    msg = Message("Reset password Token", sender="kerandisylvance@gmail.com", recipients=[recovery_email])
-                    msg.html = "<h3> Hi there, </h3>" \
-                            "<hr/>" \
-                            "<p>Click on this link to reset your password" \
-                            "Recover url: " '<p>''<strong>' + recover_url +'</strong>''</p>' \
-                            '<p> You will not be able to use this url in the next 24 Hours.' \
-                            'Please reset your password before then.</p>' \
-                            "<hr/>" \
-                            "<h5>Yummy recipes password.</h5>"
-                    with current_app.app_context():
-                        mail.send(msg)
-                    result = { 'message': 'Recovery email has been sent.' }
-                    return result, 200
-                except Exception as e:
-                    return {"error": str(e)}, 400
+                html = "<h3> Hi there, </h3>" \
+                        "<hr/>" \
+                        "<p>Click on this link to reset your password" \
+                        "Recover url: " '<p>''<strong>' + recover_url +'</strong>''</p>' \
+                        '<p> You will not be able to use this url in the next 24 Hours.' \
+                        'Please reset your password before then.</p>' \
+                        "<hr/>" \
+                        "<h5>Yummy recipes password.</h5>"
+                # Sent by the mail worker; the request does not wait on SMTP
+                mailer.enqueue("Reset password Token", "kerandisylvance@gmail.com",
+                               [recovery_email], html)
+                result = { 'message': 'Recovery email has been queued.' }
+                return result, 202
             result = { 'message': 'User with email {} does not exist.'.format(recovery_email) }
             return result, 400
         result = { 'message': 'Wrong email entered.' }
@@ -245,6 +249,7 @@ class UserPasswordResetResource(Resource):
         result = { 'message': token }
         return result
 
+    @rate_limited
     @validate_json
     def put(self, token):
         """
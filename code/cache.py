@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""Cache module, holding the caches used to avoid recomputing results that
+only change when rows are written.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from code.database import on_change
+
+# Where the SQLite stores shared by the workers of one host live by default
+DEFAULT_RUNTIME_DIR = os.path.join(tempfile.gettempdir(), 'recipes-api-{}'.format(os.getuid()))
+
+
+def private_dir(directory):
+    """Creates ``directory`` with mode 0700 if needed, and refuses one that
+    another user owns or can get into, as the files in it are trusted.
+    """
+    try:
+        os.makedirs(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError('{} must belong to this user and have mode 0700.'.format(directory))
+    return directory
+
+
+class MemoryCache(object):
+    """Thread-safe LRU cache with a TTL and tag based invalidation.
+
+    Each entry may carry tags; ``invalidate(tag)`` drops every entry that was
+    stored with that tag. A ``set`` given the ``generation`` read before its
+    value was computed is skipped if anything was invalidated since, so a
+    value computed concurrently with a write is never stored.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def current_generation(self):
+        return self.generation
+
+    def set(self, key, value, tags=(), generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._discard(key)
+            self._entries[key] = (time.time() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tag):
+        with self._lock:
+            self.generation += 1
+            for key in self._tags.pop(tag, ()):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        return { 'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses }
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SQLiteCache(object):
+    """LRU cache with a TTL and tag based invalidation kept in a SQLite file,
+    so that the worker processes of one host share entries and see each
+    other's invalidations. Same interface as ``MemoryCache``, for values
+    that JSON can encode; hit and miss counters are per process.
+
+    The file's directory must be private to the app's user.
+    """
+
+    def __init__(self, path, max_entries=1024, ttl=60):
+        private_dir(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        db = self._db()
+        db.execute('CREATE TABLE IF NOT EXISTS entries '
+                   '(key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        db.execute('CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key))')
+        db.execute('CREATE INDEX IF NOT EXISTS tags_key ON tags (key)')
+        db.execute('CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY, value INTEGER)')
+        db.execute('INSERT OR IGNORE INTO generation VALUES (1, 0)')
+
+    def _db(self):
+        # One connection per thread, reopened in forked workers
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    @staticmethod
+    def _tag(tag):
+        return repr(tag)
+
+    def current_generation(self):
+        return self._db().execute('SELECT value FROM generation').fetchone()[0]
+
+    def get(self, key, default=None):
+        db, now = self._db(), time.time()
+        row = db.execute('SELECT value, expires FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < now:
+            self.misses += 1
+            return default
+        db.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, tags=(), generation=None):
+        db, now = self._db(), time.time()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            if generation is not None and generation != self.current_generation():
+                return
+            self._discard(db, 'SELECT ?', (key,))
+            db.execute('INSERT INTO entries VALUES (?, ?, ?, ?)',
+                       (key, json.dumps(value), now + self.ttl, now))
+            db.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)',
+                           [(self._tag(tag), key) for tag in tags])
+            db.execute('DELETE FROM entries WHERE expires < ?', (now,))
+            overflow = db.execute('SELECT count(*) FROM entries').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._discard(db, 'SELECT key FROM entries ORDER BY used LIMIT ?', (overflow,))
+            db.execute('DELETE FROM tags WHERE key NOT IN (SELECT key FROM entries)')
+
+    def invalidate(self, tag):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('UPDATE generation SET value = value + 1')
+            self._discard(db, 'SELECT key FROM tags WHERE tag = ?', (self._tag(tag),))
+
+    def clear(self):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('UPDATE generation SET value = value + 1')
+            db.execute('DELETE FROM entries')
+            db.execute('DELETE FROM tags')
+
+    def stats(self):
+        entries = self._db().execute('SELECT count(*) FROM entries').fetchone()[0]
+        return { 'entries': entries, 'hits': self.hits, 'misses': self.misses }
+
+    @staticmethod
+    def _discard(db, keys, params):
+        keys = [row[0] for row in db.execute(keys, params)]
+        db.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key in keys])
+        db.executemany('DELETE FROM tags WHERE key = ?', [(key,) for key in keys])
+
+
+def owner_tags(table, owner):
+    """Tags invalidated by a write to ``table`` rows of ``owner``.
+
+    Results are stored under ``(table, owner)``, or ``(table, None)`` when not
+    scoped to one owner, so the latter go stale on every write to the table.
+    """
+    return ((table, owner), (table, None)) if owner is not None else ((table, None),)
+
+
+class CountCache(object):
+    """Per-application cache of collection totals, keyed by query and
+    invalidated whenever a row under the same owner is written.
+    """
+
+    def __init__(self, app=None):
+        on_change(self._invalidate)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGINATION_COUNT_TTL', 60)
+        app.config.setdefault('PAGINATION_COUNT_CACHE_SIZE', 1024)
+        app.extensions['count_cache'] = MemoryCache(
+            max_entries=app.config['PAGINATION_COUNT_CACHE_SIZE'],
+            ttl=app.config['PAGINATION_COUNT_TTL'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['count_cache']
+
+    def _invalidate(self, model, owner):
+        cache = current_app.extensions.get('count_cache')
+        if cache is None:
+            return
+        for tag in owner_tags(model.__tablename__, owner):
+            cache.invalidate(tag)
+
+
+count_cache = CountCache()
+
+
+CACHE_BACKENDS = {
+    'memory': lambda config: MemoryCache(
+        max_entries=config['RESPONSE_CACHE_SIZE'], ttl=config['RESPONSE_CACHE_TTL']),
+    'sqlite': lambda config: SQLiteCache(
+        config['RESPONSE_CACHE_PATH'],
+        max_entries=config['RESPONSE_CACHE_SIZE'], ttl=config['RESPONSE_CACHE_TTL']),
+}
+
+
+class ResponseCache(object):
+    """Per-application cache of encoded responses, invalidated whenever a
+    row under the owner a response was built from is written.
+
+    ``RESPONSE_CACHE_BACKEND`` picks the store: ``'sqlite'``, the default,
+    for a file shared by the workers of one host, ``'memory'`` for each
+    worker on its own, or ``'none'``. With ``'memory'``, or with several
+    hosts, other workers only see a write once their entries expire.
+    """
+
+    def __init__(self, app=None):
+        on_change(self._invalidate)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESPONSE_CACHE_BACKEND', 'sqlite')
+        app.config.setdefault('RESPONSE_CACHE_TTL', 30)
+        app.config.setdefault('RESPONSE_CACHE_SIZE', 512)
+        app.config.setdefault('RESPONSE_CACHE_PATH',
+                              os.path.join(DEFAULT_RUNTIME_DIR, 'response-cache.sqlite'))
+        backend = CACHE_BACKENDS.get(app.config['RESPONSE_CACHE_BACKEND'])
+        app.extensions['response_cache'] = backend(app.config) if backend else None
+
+    @property
+    def cache(self):
+        return current_app.extensions['response_cache']
+
+    def _invalidate(self, model, owner):
+        cache = current_app.extensions.get('response_cache')
+        if cache is None:
+            return
+        for tag in owner_tags(model.__tablename__, owner):
+            cache.invalidate(tag)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Click commands, registered on the app's ``flask`` CLI in the app factory."""
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from code.importer import READERS, import_records
+from code.mailer import mailer
+from code.models.token import Token
+from code.models.user import User
+
+tokens_cli = AppGroup('tokens', help='Manage revoked auth tokens.')
+data_cli = AppGroup('data', help='Import recipe books.')
+mail_cli = AppGroup('mail', help='Send queued email.')
+
+
+@tokens_cli.command('purge')
+def purge_tokens():
+    """Delete revocations of tokens that have expired anyway."""
+    count = Token.purge_expired()
+    click.echo('Purged {} expired token(s).'.format(count))
+
+
+@data_cli.command('import')
+@click.argument('user')
+@click.argument('source', type=click.File('rb'))
+@click.option('--format', 'format', type=click.Choice(sorted(READERS)),
+              help='Input format, guessed from the file extension by default.')
+def import_data(user, source, format):
+    """Merge an NDJSON or CSV recipe book into USER's categories."""
+    owner = User.query.get(int(user)) if user.isdigit() else User.get_by_username(user)
+    if owner is None:
+        raise click.BadParameter('No such user.', param_hint='USER')
+    if format is None:
+        format = 'csv' if source.name.endswith('.csv') else 'ndjson'
+    report = import_records(owner.id, READERS[format](source))
+    click.echo('Imported {categories} categor(ies) and {recipes} recipe(s), '
+               'rejected {rejected} record(s).'.format(**report))
+
+
+@mail_cli.command('drain')
+def drain_mail():
+    """Send every queued message that is due, then exit."""
+    sent, failed = mailer.drain()
+    click.echo('Sent {} message(s), {} failed attempt(s).'.format(sent, failed))
+
+
+@mail_cli.command('worker')
+def mail_worker():
+    """Keep sending queued messages until interrupted."""
+    mailer.run(current_app._get_current_object())
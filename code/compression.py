@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Compression module, encoding responses with the best of gzip, brotli and
+zstd that the client accepts. Brotli and zstd are used when the ``brotli``
+and ``zstandard`` packages are installed.
+"""
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: nocover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: nocover
+    zstandard = None
+
+
+def gzip_compressor(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress, compressor.flush
+
+
+def brotli_compressor(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def zstd_compressor(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+# Streaming compressors by content coding, returning (compress, flush)
+COMPRESSORS = {
+    'gzip': gzip_compressor,
+    'br': brotli_compressor if brotli is not None else None,
+    'zstd': zstd_compressor if zstandard is not None else None,
+}
+
+
+def compress(data, encoding, level):
+    compress_chunk, flush = COMPRESSORS[encoding](level)
+    return compress_chunk(data) + flush()
+
+
+def compress_stream(chunks, encoding, level):
+    """Compresses an iterable of byte chunks as it is consumed."""
+    compress_chunk, flush = COMPRESSORS[encoding](level)
+    for chunk in chunks:
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def etag_variants(etag):
+    """An entity tag and the tags of its compressed variants, as clients
+    send back whichever one they were given.
+    """
+    return [etag] + ['{}-{}'.format(etag, encoding) for encoding in COMPRESSORS]
+
+
+class Compression(object):
+    """Compresses responses after each request.
+
+    The coding is picked from ``Accept-Encoding`` among the available ones,
+    server preference (``COMPRESS_ALGORITHMS``) breaking ties. Bodies under
+    ``COMPRESS_MIN_SIZE`` bytes, of other types than ``COMPRESS_MIMETYPES``,
+    or already encoded are sent as they are; streamed bodies are compressed
+    as they are sent. ``COMPRESS_ROUTE_LEVELS`` overrides ``COMPRESS_LEVELS``
+    per endpoint.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_ALGORITHMS', ('br', 'zstd', 'gzip'))
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVELS', { 'gzip': 6, 'br': 4, 'zstd': 3 })
+        app.config.setdefault('COMPRESS_ROUTE_LEVELS', {})
+        app.config.setdefault('COMPRESS_MIMETYPES', (
+            'application/json', 'application/x-ndjson', 'text/csv', 'text/html',
+            'text/plain', 'text/css', 'application/javascript'))
+        app.after_request(self.after_request)
+
+    def negotiate(self):
+        """The accepted coding to use, or ``None``."""
+        accepted = request.accept_encodings
+        best, best_quality = None, 0
+        for encoding in current_app.config['COMPRESS_ALGORITHMS']:
+            quality = accepted.quality(encoding)
+            if COMPRESSORS.get(encoding) is not None and quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def level(self, encoding):
+        config = current_app.config
+        levels = config['COMPRESS_ROUTE_LEVELS'].get(request.endpoint, {})
+        return levels.get(encoding, config['COMPRESS_LEVELS'][encoding])
+
+    def not_modified(self, response):
+        """Gives a 304 the ``Vary`` header and entity tag of the variant the
+        client matched, which the negotiated coding suffixes.
+        """
+        response.vary.add('Accept-Encoding')
+        etag, weak = response.get_etag()
+        encoding = self.negotiate()
+        if etag and encoding is not None:
+            variant = '{}-{}'.format(etag, encoding)
+            if request.if_none_match.contains_weak(variant):
+                response.set_etag(variant, weak)
+        return response
+
+    def after_request(self, response):
+        config = current_app.config
+        if response.status_code == 304:
+            return self.not_modified(response)
+        if (response.mimetype not in config['COMPRESS_MIMETYPES']
+                or response.status_code < 200 or response.status_code in (204, 206)
+                or response.direct_passthrough or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.cache_control.no_transform:
+            return response
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        level = self.level(encoding)
+        if response.is_streamed:
+            body = response.response
+            if hasattr(body, 'close'):
+                response.call_on_close(body.close)
+            chunks = (chunk.encode(response.charset) if isinstance(chunk, str) else chunk
+                      for chunk in body)
+            response.response = compress_stream(chunks, encoding, level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(data, encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag('{}-{}'.format(etag, encoding), weak)
+        return response
+
+
+compression = Compression()
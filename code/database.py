@@ -3,6 +3,9 @@
 utilities.
 """
 import datetime
+from flask import g, has_request_context
+from sqlalchemy import func, or_
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import relationship
 
 from .extensions import db
@@ -11,11 +14,57 @@ from .compat import basestring
 # Alias common SQLAlchemy names
 relationship = relationship
 
+# Callbacks run with (model class, owner id) whenever a record is written
+_change_listeners = []
+
+# Indexes shaped by the app's config, as (table, name, build(config, backend))
+_configured_indexes = []
+
+
+def on_change(func):
+    """Register ``func`` to be called after records are saved or deleted."""
+    _change_listeners.append(func)
+    return func
+
+
+def notify_change(model, owner=None):
+    """Tell the listeners that rows of ``model`` under ``owner`` changed."""
+    for listener in _change_listeners:
+        listener(model, owner)
+
+
+def remember(*instances):
+    """Keep records in a cache scoped to the current request."""
+    if not has_request_context():
+        return
+    entities = g.setdefault('entities', {})
+    for instance in instances:
+        entities[(type(instance), instance.id)] = instance
+
+
+def recall(model, id):
+    """Return a record cached for the current request, if any."""
+    if not has_request_context():
+        return None
+    return g.get('entities', {}).get((model, id))
+
+
+def forget(instance):
+    """Drop a record from the request cache."""
+    if has_request_context():
+        g.get('entities', {}).pop((type(instance), instance.id), None)
+
 
 class CRUDMixin(object):
     """Mixin that adds convenience methods for CRUD (create, read, update, delete)
     operations.
     """
+    # Name of the column holding the id of the record's owner, if any
+    __owner__ = None
+
+    @property
+    def owner_id(self):
+        return getattr(self, self.__owner__) if self.__owner__ else None
 
     @classmethod
     def create(cls, **kwargs):
@@ -23,6 +72,65 @@ class CRUDMixin(object):
         instance = cls(**kwargs)
         return instance.save()
 
+    @classmethod
+    def bulk_insert(cls, rows, commit=True):
+        """Insert many records with one multi-row INSERT, bypassing the ORM.
+        Timestamps are filled in when the table has them. Callers bound the
+        number of rows (``BATCH_MAX_ITEMS``, ``IMPORT_CHUNK_SIZE``) so the
+        statement stays within the driver's parameter limit.
+        """
+        now = datetime.datetime.now()
+        columns = cls.__table__.c
+        for row in rows:
+            for name in ('created_at', 'modified_at'):
+                if name in columns:
+                    row.setdefault(name, now)
+        db.session.execute(cls.__table__.insert().values(rows))
+        if commit:
+            db.session.commit()
+        owners = set(row.get(cls.__owner__) for row in rows) if cls.__owner__ else set([None])
+        for owner in owners:
+            notify_change(cls, owner)
+        return len(rows)
+
+    @classmethod
+    def bulk_update(cls, query, values, owner=None, commit=True):
+        """Update every record matched by ``query`` with one UPDATE."""
+        values = dict(values)
+        if 'modified_at' in cls.__table__.c:
+            values['modified_at'] = datetime.datetime.now()
+        count = query.update(values, synchronize_session=False)
+        if commit:
+            db.session.commit()
+        notify_change(cls, owner)
+        return count
+
+    @classmethod
+    def bulk_delete(cls, query, owner=None, commit=True):
+        """Delete every record matched by ``query``, and their children, with
+        set-based DELETEs.
+        """
+        ids = [id for (id,) in query.with_entities(cls.id)]
+        changes = []
+        if ids:
+            changes = cls.delete_children(ids)
+            cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        if commit:
+            db.session.commit()
+        notify_change(cls, owner)
+        for model, model_owner in changes:
+            notify_change(model, model_owner)
+        return len(ids)
+
+    @classmethod
+    def delete_children(cls, ids):
+        """Remove the rows referencing records about to be bulk deleted, which
+        the ORM cascades do not reach.
+        :return: the ``(model, owner)`` pairs whose change is notified once
+            the deletion is committed
+        """
+        return []
+
     def update(self, commit=True, **kwargs):
         """Update specific fields of a record."""
         # Prevent changing ID of object
@@ -39,12 +147,17 @@ class CRUDMixin(object):
         db.session.add(self)
         if commit:
             db.session.commit()
+        notify_change(type(self), self.owner_id)
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
+        owner_id = self.owner_id
+        forget(self)
         db.session.delete(self)
-        return commit and db.session.commit()
+        result = commit and db.session.commit()
+        notify_change(type(self), owner_id)
+        return result
 
 
 class Model(CRUDMixin, db.Model):
@@ -70,10 +183,101 @@ class SurrogatePK(object):
             (isinstance(id, basestring) and id.isdigit(),
              isinstance(id, (int, float))),
         ):
-            return cls.query.get(int(id))
+            instance = recall(cls, int(id))
+            if instance is None:
+                instance = cls.query.get(int(id))
+                if instance is not None:
+                    remember(instance)
+            return instance
         return None
 
 
+class SearchableMixin(object):
+    """A mixin that adds ranked full-text search over the ``__searchable__``
+    columns. PostgreSQL uses a ``tsvector`` matching the index created by
+    ``create_search_index``; other databases fall back to substring matching.
+    """
+    __searchable__ = ()
+    __search_config__ = 'english'
+
+    @classmethod
+    def search_vector(cls):
+        document = getattr(cls, cls.__searchable__[0])
+        for name in cls.__searchable__[1:]:
+            document = document + ' ' + getattr(cls, name)
+        return func.to_tsvector(cls.__search_config__, document)
+
+    @classmethod
+    def search(cls, query, term):
+        """Restrict ``query`` to records matching ``term``, best match first."""
+        if db.session.get_bind().dialect.name != 'postgresql':
+            pattern = '%' + term + '%'
+            return query.filter(or_(
+                *[getattr(cls, name).ilike(pattern) for name in cls.__searchable__]))
+        vector = cls.search_vector()
+        terms = func.plainto_tsquery(cls.__search_config__, term)
+        # id breaks ties between equal ranks, so pages are stable
+        return query.filter(vector.op('@@')(terms)).order_by(
+            func.ts_rank(vector, terms).desc(), cls.id)
+
+
+def create_search_index(model):
+    """Declare the GIN index behind ``SearchableMixin.search``, which
+    ``configure_indexes`` puts in the model's table on PostgreSQL only.
+    """
+    table = model.__table__
+
+    def build(config, backend):
+        if backend not in ('postgresql', 'postgres'):
+            return None
+        columns = [table.c[name] for name in model.__searchable__]
+        document = columns[0]
+        for column in columns[1:]:
+            document = document + ' ' + column
+        return db.Index('ix_{}_search'.format(table.name),
+                        func.to_tsvector(model.__search_config__, document),
+                        postgresql_using='gin')
+    _configured_indexes.append((table, 'ix_{}_search'.format(table.name), build))
+
+
+def unique_per_owner(model, column):
+    """Declare a unique index making ``column`` unique among the records of
+    one owner. ``configure_indexes`` puts it in the model's table, on
+    ``lower(column)`` when the app's ``UNIQUE_TITLES_IGNORE_CASE`` is set.
+    """
+    table = model.__table__
+
+    def build(config, backend):
+        expression = table.c[column]
+        if config.get('UNIQUE_TITLES_IGNORE_CASE'):
+            expression = func.lower(expression)
+        return db.Index('uq_{0}_{1}_{2}'.format(table.name, model.__owner__, column),
+                        table.c[model.__owner__], expression, unique=True)
+    _configured_indexes.append(
+        (table, 'uq_{0}_{1}_{2}'.format(table.name, model.__owner__, column), build))
+
+
+def configure_indexes(app):
+    """Put the indexes that depend on the app's config and database in the
+    table metadata, where ``create_all`` and ``flask db migrate`` see them.
+    """
+    backend = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    for table, name, build in _configured_indexes:
+        for index in list(table.indexes):
+            if index.name == name:
+                table.indexes.discard(index)
+        # Built on the table's columns, the index adds itself to the table
+        build(app.config, backend)
+
+
+def is_unique_violation(error):
+    """Whether an ``IntegrityError`` was raised by a unique constraint."""
+    code = getattr(error.orig, 'pgcode', None)
+    if code is not None:
+        return code == '23505'
+    return 'unique' in str(error.orig).lower()
+
+
 def ReferenceCol(tablename, nullable=False, pk_name='id', **kwargs):
     """Column that adds primary key foreign key reference.
 
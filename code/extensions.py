@@ -4,8 +4,8 @@ in __init__.py
 """
 
 
-from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy()
+from code.replicas import RoutingSQLAlchemy
+db = RoutingSQLAlchemy()
 
 # from flask_httpauth import HTTPBasicAuth
 # auth = HTTPBasicAuth()
@@ -1,11 +1,31 @@
 #!/usr/bin/env python
 
+import base64
+import contextlib
+import datetime
 import functools
+import hashlib
+import operator
 from functools import wraps
-from flask import request, url_for, abort, json
-from code.models.recipe import Recipe
-from code.models.category import Category
+from flask import Response, current_app, g, request, url_for, abort, json
+from flask_restful.utils import unpack
+from sqlalchemy import Column, DateTime, and_, func, or_
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.visitors import iterate
+from code.cache import count_cache, response_cache
+from code.compression import etag_variants
+from code.database import is_unique_violation
+from code.extensions import db
+from code.replicas import read_from_a_replica
+from code.serializers import output_json
 from werkzeug.exceptions import BadRequest
+from werkzeug.http import http_date, parse_date, quote_etag
+from werkzeug.wrappers import Response as ResponseBase
+
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 
 def validate_json(f):
@@ -21,42 +41,486 @@ def validate_json(f):
     return wrapper
 
 
-def paginate(max_limit=3):
+def paginate(max_limit=3, sort_key='id', count='exact'):
+    """ Paginates the query returned by the decorated resource.
+
+    Pages are addressed with ``page``/``limit``, or with the opaque ``after``
+    and ``before`` cursors of keyset mode, which orders by ``(sort_key, id)``
+    and skips the total count unless ``total=true`` is passed.
+
+    ``count`` picks how totals are computed (see ``COUNT_STRATEGIES``); the
+    ``PAGINATION_COUNT`` setting overrides it per endpoint.
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            page = request.args.get('page', 1, type=int)
             limit = min(request.args.get('limit', max_limit, type=int), max_limit)
             query = func(*args, **kwargs)
-            p = query.paginate(page, limit)
-            meta = { 'page': page, 'limit': limit, 'total': p.total, 'pages': p.pages, }
+            model = query.column_descriptions[0]['entity']
+            # What the page is built from, for the response cache
+            g.cache_tags = [(model.__tablename__, query_owner(query))]
+            if g.get('sparse_fields'):
+                query = query.options(load_only(*project_columns(
+                    model, g.sparse_fields | set(['id', 'modified_at', sort_key]))))
+            strategy = current_app.config['PAGINATION_COUNT'].get(request.endpoint, count)
+            if 'after' in request.args or 'before' in request.args:
+                return paginate_keyset(query, limit, sort_key, strategy, kwargs)
+            page = request.args.get('page', 1, type=int)
+            if page < 1 or limit < 0:
+                abort(404)
+            rows = query.limit(limit + 1).offset((page - 1) * limit).all()
+            items = rows[:limit]
+            if not items and page != 1:
+                abort(404)
+            total, exact = count_total(query, strategy)
+            pages = -(-total // limit) if limit else 0
+            meta = { 'page': page, 'limit': limit, 'total': total, 'pages': pages, 'exact': exact, }
             links = {}
-            if p.has_next:
-                links['next'] = url_for(request.endpoint, page=p.next_num, limit=limit, **kwargs)
-            if p.has_prev:
-                links['prev'] = url_for(request.endpoint, page=p.prev_num, limit=limit, **kwargs)
+            if len(rows) > limit:
+                links['next'] = url_for(request.endpoint, page=page + 1, limit=limit, **kwargs)
+            if page > 1:
+                links['prev'] = url_for(request.endpoint, page=page - 1, limit=limit, **kwargs)
             links['first'] = url_for(request.endpoint, page=1, limit=limit, **kwargs)
-            links['last'] = url_for(request.endpoint, page=p.pages, limit=limit, **kwargs)
+            links['last'] = url_for(request.endpoint, page=pages, limit=limit, **kwargs)
             meta['links'] = links
-            result = { 'items': p.items, 'meta': meta }
+            result = { 'items': items, 'meta': meta }
             return result, 200
         return wrapped
     return decorator
 
-def abort_if_exists(user_id, category_name=None, category_id=None, recipe_name=None):
-    category = None
-    recipe = None
-    if category_name:
-        categories = Category.get_user_all(user_id)
-        categorylist = []
-        for category in categories:
-            categorylist.append(category.title)
-        if category_name in categorylist:
-            abort(409, {"message" : "Category already exists"})
-    if recipe_name:
-        category = Category.get_by_id(category_id)
-        if category.user_id == user_id:
-            if Recipe.recipe_exists(category_id, recipe_name):
-                abort(409, {"message" : "Recipe already exists"})
+
+def count_exact(query):
+    return query.order_by(None).count(), True
+
+
+def count_cached(query):
+    """ Counts once per distinct query, until a row under the owner the query
+    filters on is written. The cache is per worker and only sees the
+    worker's own writes, so totals are reported as not exact. Counts read
+    from a replica are not stored.
+    """
+    statement = query.order_by(None).statement.compile()
+    params = tuple(sorted(statement.params.items()))
+    table = query.column_descriptions[0]['entity'].__tablename__
+    key = (table, str(statement), params)
+    total = count_cache.cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        if not read_from_a_replica():
+            count_cache.cache.set(key, total, tags=[(table, query_owner(query))])
+    return total, False
+
+
+def count_estimated(query):
+    """ Uses the planner's row estimate, falling back to an exact count on
+    databases other than PostgreSQL.
+    """
+    dialect = db.session.get_bind().dialect
+    if dialect.name != 'postgresql':
+        return count_exact(query)
+    return planner_estimate(query, dialect), False
+
+
+def planner_estimate(query, dialect):
+    """ The rows PostgreSQL's planner expects ``query`` to return. """
+    statement = query.order_by(None).statement.compile(dialect=dialect)
+    # Run on the DB-API cursor so the driver binds the compiled parameters
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(statement), statement.params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+COUNT_STRATEGIES = {
+    'exact': count_exact,
+    'cached': count_cached,
+    'estimated': count_estimated,
+}
+
+
+def count_total(query, strategy):
+    return COUNT_STRATEGIES[strategy](query)
+
+
+def query_owner(query):
+    """ The owner id an ORM query filters on, or ``None``. """
+    model = query.column_descriptions[0]['entity']
+    if not model.__owner__ or query.whereclause is None:
+        return None
+    for element in iterate(query.whereclause, {}):
+        if (isinstance(element, BinaryExpression) and element.operator is operator.eq
+                and isinstance(element.left, Column) and isinstance(element.right, BindParameter)
+                and element.left.table is model.__table__ and element.left.name == model.__owner__):
+            return element.right.value
+    return None
+
+
+def encode_cursor(item, sort_key):
+    value = getattr(item, sort_key)
+    if isinstance(value, datetime.datetime):
+        value = value.strftime(CURSOR_DATETIME_FORMAT)
+    raw = json.dumps([value, item.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, column):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, item_id = json.loads(raw.decode('utf-8'))
+        if isinstance(column.type, DateTime):
+            value = datetime.datetime.strptime(value, CURSOR_DATETIME_FORMAT)
+        return value, int(item_id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        abort(400, { "message": "Invalid pagination cursor." })
+
+
+def cache_response(func):
+    """ Serves the decorated collection GET from the response cache.
+
+    Entries are keyed by endpoint, user and query string, hold the encoded
+    response, and are tagged with the owner of the paginated query so any
+    write under that owner drops them. Hits still answer conditional
+    requests with 304.
+
+    Writes only drop the entries of the store they reach: with the
+    ``'memory'`` backend, other workers keep serving their copy until it
+    expires (``RESPONSE_CACHE_TTL``), so use ``'sqlite'`` with several
+    workers on a host. Responses read from a replica are not stored, as
+    they could hold rows older than the user's last write.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        cache = response_cache.cache
+        if cache is None:
+            return func(*args, **kwargs)
+        key = '{}|{}|{}|{}'.format(request.endpoint, g.user.id, request.full_path,
+                                   current_app.config['JSON_SERIALIZER'])
+        entry = cache.get(key)
+        if entry is not None:
+            status, body, headers, etag, last_modified = entry
+            if last_modified is not None:
+                last_modified = parse_date(last_modified)
+            if etag is not None and not_modified(etag, last_modified):
+                response = Response(status=304, headers=headers)
+            else:
+                response = Response(body, status, headers)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        generation = cache.current_generation()
+        g.cache_tags = []
+        resp = func(*args, **kwargs)
+        if isinstance(resp, ResponseBase):
+            return resp
+        data, code, headers = unpack(resp)
+        response = output_json(data, code, headers)
+        response.headers['Content-Type'] = 'application/json'
+        if code == 200 and g.cache_tags and not read_from_a_replica():
+            etag = response.get_etag()[0]
+            last_modified = http_date(response.last_modified) if response.last_modified else None
+            cache.set(key, (code, response.get_data(as_text=True), list(response.headers.items()),
+                            etag, last_modified),
+                      tags=g.cache_tags, generation=generation)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapped
+
+
+def project_columns(model, names):
+    """ The column attributes of ``model`` among ``names``. """
+    return sorted(set(names) & set(sqlalchemy_inspect(model).column_attrs.keys()))
+
+
+def conditional(func):
+    """ Adds a strong ETag and Last-Modified to the item or page returned by
+    the decorated resource, and answers a matching ``If-None-Match`` or
+    ``If-Modified-Since`` with 304 before anything is serialized.
+
+    The ETag covers the ids and ``modified_at`` of every item, the page's
+    total and the query string, so it also changes when items are removed
+    from a page. Last-Modified is the latest ``modified_at`` and cannot see
+    removals, so ``If-None-Match`` wins when both are sent.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        resp = func(*args, **kwargs)
+        if isinstance(resp, ResponseBase):
+            return resp
+        data, code, headers = unpack(resp)
+        if code != 200:
+            return resp
+        etag, last_modified = validators(data)
+        headers = dict(headers or {}, ETag=quote_etag(etag))
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified)
+        if not_modified(etag, last_modified):
+            return Response(status=304, headers=headers)
+        return data, code, headers
+    return wrapped
+
+
+def page_items(data):
+    """ The items of a page, or the single item returned by a resource. """
+    if isinstance(data, dict) and 'items' in data:
+        return data['items']
+    return [data]
+
+
+def embed(**loaders):
+    """ Loads the children asked for with ``?include=`` for the item or page
+    returned by the decorated resource, using one query per kind of child.
+
+    Each loader takes the parents and a per-parent limit, read from
+    ``?<name>_limit=``, and sets ``included_<name>`` on every parent.
+    Includes are named after the child table, so cached responses are also
+    tagged with every parent as an owner of that table.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            resp = func(*args, **kwargs)
+            includes = g.get('includes')
+            if not includes or isinstance(resp, ResponseBase):
+                return resp
+            data, code, headers = unpack(resp)
+            if code != 200:
+                return resp
+            items = page_items(data)
+            max_limit = current_app.config['INCLUDE_MAX_LIMIT']
+            for name in includes:
+                limit = request.args.get('{}_limit'.format(name),
+                                         current_app.config['INCLUDE_LIMIT'], type=int)
+                loaders[name](items, max(0, min(limit, max_limit)))
+                if 'cache_tags' in g:
+                    g.cache_tags.extend((name, item.id) for item in items)
+            return resp
+        return wrapped
+    return decorator
+
+
+def validators(data):
+    """ The ETag and last modification time of an item or page of items,
+    including the children embedded in them.
+    """
+    items = page_items(data)
+    total = data['meta'].get('total') if isinstance(data, dict) and 'meta' in data else None
+    includes = sorted(g.get('includes') or ())
+    digest = hashlib.sha1()
+    digest.update(json.dumps([request.full_path, total,
+                              current_app.config['JSON_SERIALIZER']]).encode('utf-8'))
+    last_modified = None
+    for item in items:
+        entries = [item]
+        for name in includes:
+            entries.extend(getattr(item, 'included_' + name))
+        for entry in entries:
+            digest.update('|{}:{}:{}'.format(entry.__tablename__, entry.id,
+                                             entry.modified_at.isoformat()).encode('utf-8'))
+            if last_modified is None or entry.modified_at > last_modified:
+                last_modified = entry.modified_at
+    return digest.hexdigest(), utc(last_modified) if last_modified is not None else None
+
+
+def utc(value):
+    """ An aware UTC datetime. Naive values are the server's local time, as
+    stored in ``modified_at``.
+    """
+    return value.astimezone(datetime.timezone.utc)
+
+
+def not_modified(etag, last_modified):
+    """ Whether the client's cached copy is still current. """
+    if request.if_none_match:
+        return any(request.if_none_match.contains_weak(tag) for tag in etag_variants(etag))
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    # HTTP dates are in UTC
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def paginate_keyset(query, limit, sort_key, strategy, view_args):
+    """ Fetches one page of ``query`` after or before a cursor, without an
+    OFFSET scan.
+    """
+    model = query.column_descriptions[0]['entity']
+    key, pk = getattr(model, sort_key), model.id
+    before = request.args.get('before')
+    after = request.args.get('after') if before is None else None
+    cursor = before or after
+    seek = query.order_by(None)
+    if cursor:
+        value, item_id = decode_cursor(cursor, key)
+        if before is not None:
+            condition = pk < item_id if key is pk else or_(
+                key < value, and_(key == value, pk < item_id))
         else:
-            abort(403, {"message" : "Category does not belong to this user"})
+            condition = pk > item_id if key is pk else or_(
+                key > value, and_(key == value, pk > item_id))
+        seek = seek.filter(condition)
+    if before is not None:
+        seek = seek.order_by(key.desc(), pk.desc())
+    else:
+        seek = seek.order_by(key.asc(), pk.asc())
+    rows = seek.limit(limit + 1).all()
+    more = len(rows) > limit
+    items = rows[:limit]
+    if before is not None:
+        items.reverse()
+        has_prev, has_next = more, bool(cursor)
+    else:
+        has_prev, has_next = bool(cursor), more
+
+    meta = { 'page': None, 'limit': limit, 'total': None, 'pages': None, 'exact': None, }
+    if request.args.get('total', '').lower() in ('1', 'true'):
+        meta['total'], meta['exact'] = count_total(query, strategy)
+        meta['pages'] = -(-meta['total'] // limit) if limit else 0
+    links = {}
+    if has_next and items:
+        links['next'] = url_for(request.endpoint, after=encode_cursor(items[-1], sort_key),
+                                limit=limit, **view_args)
+    if has_prev and items:
+        links['prev'] = url_for(request.endpoint, before=encode_cursor(items[0], sort_key),
+                                limit=limit, **view_args)
+    links['first'] = url_for(request.endpoint, after='', limit=limit, **view_args)
+    links['last'] = url_for(request.endpoint, before='', limit=limit, **view_args)
+    meta['links'] = links
+    result = { 'items': items, 'meta': meta }
+    return result, 200
+
+
+@contextlib.contextmanager
+def abort_on_conflict(message):
+    """ Turns unique constraint violations raised by the wrapped writes into
+    a 409 response.
+    """
+    try:
+        yield
+    except IntegrityError as e:
+        db.session.rollback()
+        if not is_unique_violation(e):
+            raise
+        abort(409, {"message" : message})
+
+
+def create_batch(model, owner_id, items, conflict_message):
+    """ Creates ``items`` under one owner in a single transaction.
+
+    Items are validated together, checked for duplicate titles with one
+    query and inserted with multi-row INSERTs. Returns the per-item results,
+    in request order, and the response status.
+    """
+    if isinstance(items, dict):
+        items = items.get('items')
+    if not isinstance(items, list) or not items:
+        abort(400, {"message" : "Provide a list of items."})
+    if len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        abort(413, {"message" : "A batch takes at most {} items.".format(
+            current_app.config['BATCH_MAX_ITEMS'])})
+
+    ignore_case = current_app.config['UNIQUE_TITLES_IGNORE_CASE']
+    fold = (lambda title: title.lower()) if ignore_case else (lambda title: title)
+    results = [validate_item(model, owner_id, item, index) for index, item in enumerate(items)]
+    valid = [result for result in results if result['status'] is None]
+
+    title_column = func.lower(model.title) if ignore_case else model.title
+    taken = set()
+    if valid:
+        titles = [fold(items[result['index']]['title']) for result in valid]
+        taken = set(title for (title,) in db.session.query(title_column).filter(
+            getattr(model, model.__owner__) == owner_id, title_column.in_(titles)))
+
+    rows = []
+    for result in valid:
+        item = items[result['index']]
+        if fold(item['title']) in taken:
+            result.update(status=409, message=conflict_message)
+            continue
+        taken.add(fold(item['title']))
+        rows.append({ model.__owner__: owner_id, 'title': item['title'],
+                      'description': item['description'] })
+        result['status'] = 201
+
+    if rows:
+        with abort_on_conflict(conflict_message):
+            model.bulk_insert(rows)
+        created = dict(db.session.query(model.title, model.id).filter(
+            getattr(model, model.__owner__) == owner_id,
+            model.title.in_([row['title'] for row in rows])))
+        for result in results:
+            if result['status'] == 201:
+                result['id'] = created.get(items[result['index']]['title'])
+
+    failed = len([result for result in results if result['status'] != 201])
+    response = { 'items': results, 'created': len(rows), 'failed': failed }
+    return response, 201 if not failed else 207
+
+
+def validate_item(model, owner_id, item, index):
+    """ Checks one item of a batch, returning its result with a ``None``
+    status when it is valid.
+    """
+    result = { 'index': index, 'status': None }
+    if not isinstance(item, dict):
+        result.update(status=400, message="Item must be an object.")
+        return result
+    for name in ('title', 'description'):
+        value = item.get(name)
+        if not isinstance(value, str) or not value.strip():
+            result.update(status=400, message="The parameter '{}' is required.".format(name))
+            return result
+        if len(value) > model.__table__.c[name].type.length:
+            result.update(status=400, message="The parameter '{}' is too long.".format(name))
+            return result
+    if item.get(model.__owner__, owner_id) != owner_id:
+        result.update(status=400, message="Provide valid {}.".format(model.__owner__.replace('_', ' ')))
+    return result
+
+
+def bulk_selection(model, owner_id):
+    """ Query for the owner's records picked by an ``ids`` list, given in the
+    JSON body or as a comma separated query argument, and/or by the ``title``
+    substring filter.
+    """
+    body = request.get_json(silent=True)
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if ids is None and request.args.get('ids'):
+        ids = request.args['ids'].split(',')
+    title = request.args.get('title')
+    if ids is None and not title:
+        abort(400, {"message" : "Provide ids or a title filter."})
+    query = model.query.filter(getattr(model, model.__owner__) == owner_id)
+    if ids is not None:
+        try:
+            ids = [int(id) for id in ids]
+        except (TypeError, ValueError):
+            abort(400, {"message" : "Ids must be integers."})
+        query = query.filter(model.id.in_(ids))
+    if title:
+        query = query.filter(model.title.ilike('%' + title + '%'))
+    return query
+
+
+def bulk_values(model, *names):
+    """ The fields a bulk update sets, taken from the JSON body and checked
+    like the items of a batch.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        body = {}
+    values = dict((name, body[name]) for name in names if body.get(name) is not None)
+    if not values:
+        abort(400, {"message" : "Provide {} to update.".format(' or '.join(names))})
+    for name, value in values.items():
+        if not isinstance(value, str) or not value.strip():
+            abort(400, {"message" : "The parameter '{}' must be a non-empty string.".format(name)})
+        if len(value) > model.__table__.c[name].type.length:
+            abort(400, {"message" : "The parameter '{}' is too long.".format(name)})
+    return values
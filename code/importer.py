@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Importer module, loading recipe books in the export shape into a user's
+categories and recipes.
+
+Input is read as records of ``(title, description, recipe_title,
+recipe_description)``; a record without a recipe only creates its category.
+Existing titles are never overwritten: duplicate categories are merged into
+the existing one and duplicate recipes are skipped.
+"""
+import csv
+import datetime
+import io
+import itertools
+import json
+
+from flask import current_app
+from sqlalchemy import text
+
+from code.database import notify_change
+from code.extensions import db
+from code.models.category import Category
+from code.models.recipe import Recipe
+
+CSV_COLUMNS = ('title', 'description', 'recipe_title', 'recipe_description')
+
+
+def read_ndjson(lines):
+    """Records of NDJSON lines holding a category with nested ``recipes``,
+    as written by the export endpoint. Unreadable lines yield ``None``.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            category = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        if not isinstance(category, dict):
+            yield None
+            continue
+        recipes = category.get('recipes') or []
+        if not isinstance(recipes, list):
+            yield None
+            continue
+        title, description = category.get('title'), category.get('description')
+        if not recipes:
+            yield (title, description, None, None)
+        for recipe in recipes:
+            if not isinstance(recipe, dict):
+                yield None
+                continue
+            yield (title, description, recipe.get('title'), recipe.get('description'))
+
+
+def read_csv(lines):
+    """Records of CSV lines with a ``title,description,recipe_title,
+    recipe_description`` header.
+    """
+    lines = (line.decode('utf-8') if isinstance(line, bytes) else line for line in lines)
+    for row in csv.DictReader(lines):
+        if None in row or any(name not in row for name in CSV_COLUMNS):
+            yield None
+            continue
+        yield (row['title'], row['description'],
+               row['recipe_title'] or None, row['recipe_description'] or None)
+
+
+READERS = {
+    'ndjson': read_ndjson,
+    'csv': read_csv,
+}
+
+
+def valid_record(record):
+    """Whether a record fits the category and recipe columns."""
+    if record is None:
+        return False
+    title, description, recipe_title, recipe_description = record
+    checks = [(title, Category.title), (description, Category.description)]
+    if recipe_title is not None or recipe_description is not None:
+        checks += [(recipe_title, Recipe.title), (recipe_description, Recipe.description)]
+    for value, column in checks:
+        if not isinstance(value, str) or not value.strip():
+            return False
+        if len(value) > column.type.length:
+            return False
+    return True
+
+
+def chunked(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_records(user_id, records, chunk_size=None):
+    """Loads ``records`` into the categories and recipes of a user in one
+    transaction, reading them ``IMPORT_CHUNK_SIZE`` at a time.
+
+    Uses ``COPY`` into a staging table and a set-based merge on PostgreSQL,
+    and batched inserts elsewhere.
+    :return: counts of created categories and recipes and rejected records
+    """
+    chunk_size = chunk_size or current_app.config['IMPORT_CHUNK_SIZE']
+    importer = CopyImporter if db.session.get_bind().dialect.name == 'postgresql' \
+        else BatchImporter
+    loader = importer(user_id, current_app.config['UNIQUE_TITLES_IGNORE_CASE'])
+    rejected = 0
+    try:
+        for chunk in chunked(records, chunk_size):
+            valid = [record for record in chunk if valid_record(record)]
+            rejected += len(chunk) - len(valid)
+            if valid:
+                loader.load(valid)
+        categories, category_ids = loader.finish()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    notify_change(Category, user_id)
+    for category_id in category_ids:
+        notify_change(Recipe, category_id)
+    return { 'categories': categories, 'recipes': loader.recipes, 'rejected': rejected }
+
+
+class CopyImporter(object):
+    """Streams records into a temporary staging table with ``COPY`` and
+    merges it with ``INSERT ... ON CONFLICT DO NOTHING``.
+    """
+
+    def __init__(self, user_id, ignore_case):
+        self.user_id = user_id
+        self.fold = 'lower({})' if ignore_case else '{}'
+        self.recipes = 0
+        db.session.execute(text(
+            'CREATE TEMPORARY TABLE import_staging ('
+            ' ordinal bigserial,'
+            ' title varchar(100), description varchar(255),'
+            ' recipe_title varchar(100), recipe_description varchar(255)'
+            ') ON COMMIT DROP'))
+
+    def load(self, records):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(records)
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY import_staging (title, description, recipe_title, recipe_description) '
+                'FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+
+    def finish(self):
+        params = { 'user_id': self.user_id, 'now': datetime.datetime.now() }
+        fold = self.fold.format
+        # The first occurrence of a title wins
+        categories = db.session.execute(text(
+            'INSERT INTO categories (user_id, title, description, created_at, modified_at) '
+            'SELECT DISTINCT ON ({key}) :user_id, title, description, :now, :now '
+            'FROM import_staging ORDER BY {key}, ordinal '
+            'ON CONFLICT DO NOTHING'.format(key=fold('title'))), params).rowcount
+        created = db.session.execute(text(
+            'INSERT INTO recipes (category_id, title, description, created_at, modified_at) '
+            'SELECT DISTINCT ON (c.id, {key}) c.id, s.recipe_title, s.recipe_description, :now, :now '
+            'FROM import_staging s JOIN categories c '
+            'ON c.user_id = :user_id AND {category} = {staged} '
+            'WHERE s.recipe_title IS NOT NULL ORDER BY c.id, {key}, s.ordinal '
+            'ON CONFLICT DO NOTHING RETURNING category_id'.format(
+                key=fold('s.recipe_title'), category=fold('c.title'),
+                staged=fold('s.title'))), params).fetchall()
+        self.recipes = len(created)
+        return categories, set(category_id for (category_id,) in created)
+
+
+class BatchImporter(object):
+    """Merges each chunk with one lookup per table and multi-row inserts,
+    for databases without ``COPY``.
+    """
+
+    def __init__(self, user_id, ignore_case):
+        self.user_id = user_id
+        self.ignore_case = ignore_case
+        self.categories = 0
+        self.recipes = 0
+        self.category_ids = set()
+
+    def fold(self, title):
+        return title.lower() if self.ignore_case else title
+
+    def column(self, model):
+        return db.func.lower(model.title) if self.ignore_case else model.title
+
+    def load(self, records):
+        category_ids = self.load_categories(records)
+        self.load_recipes(records, category_ids)
+
+    def load_categories(self, records):
+        column = self.column(Category)
+        titles = set(self.fold(record[0]) for record in records)
+        existing = dict(db.session.query(column, Category.id).filter(
+            Category.user_id == self.user_id, column.in_(titles)))
+        rows = []
+        for title, description, _, _ in records:
+            if self.fold(title) in existing:
+                continue
+            existing[self.fold(title)] = None
+            rows.append({ 'user_id': self.user_id, 'title': title, 'description': description })
+        if rows:
+            Category.bulk_insert(rows, commit=False)
+            self.categories += len(rows)
+            existing.update(db.session.query(column, Category.id).filter(
+                Category.user_id == self.user_id,
+                column.in_([self.fold(row['title']) for row in rows])))
+        return existing
+
+    def load_recipes(self, records, category_ids):
+        column = self.column(Recipe)
+        wanted = [(category_ids[self.fold(record[0])], record[2], record[3])
+                  for record in records if record[2] is not None]
+        if not wanted:
+            return
+        existing = set(db.session.query(Recipe.category_id, column).filter(
+            Recipe.category_id.in_(set(category_id for category_id, _, _ in wanted)),
+            column.in_(set(self.fold(title) for _, title, _ in wanted))))
+        rows = []
+        for category_id, title, description in wanted:
+            key = (category_id, self.fold(title))
+            if key in existing:
+                continue
+            existing.add(key)
+            rows.append({ 'category_id': category_id, 'title': title, 'description': description })
+        if rows:
+            Recipe.bulk_insert(rows, commit=False)
+            self.recipes += len(rows)
+            self.category_ids.update(row['category_id'] for row in rows)
+
+    def finish(self):
+        return self.categories, self.category_ids
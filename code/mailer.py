@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""Mailer module, sending email through a database backed outbox so that
+requests never wait on the SMTP server.
+"""
+import logging
+import os
+import smtplib
+import socket
+import threading
+
+from flask import current_app
+
+from code.extensions import db, mail
+from code.models.outbox import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Mailer(object):
+    """Queues email in the outbox and drains it in batches, sending each
+    batch over one SMTP connection.
+
+    With ``MAIL_QUEUE_WORKER`` set to ``'thread'`` every process drains the
+    outbox from a background thread, woken when it queues a message and
+    every ``MAIL_QUEUE_POLL_SECONDS`` for retries. Otherwise run
+    ``flask mail worker`` next to the app. Workers lock the messages they
+    send, so any number of them can run.
+    """
+
+    def __init__(self, app=None):
+        self._thread = None
+        self._thread_pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_QUEUE_WORKER', 'thread')
+        app.config.setdefault('MAIL_QUEUE_BATCH_SIZE', 50)
+        app.config.setdefault('MAIL_QUEUE_POLL_SECONDS', 30)
+        app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 30)
+
+    def enqueue(self, subject, sender, recipients, html):
+        """Stores a message in the outbox and wakes the worker."""
+        message = OutboxMessage(subject, sender, recipients, html)
+        message.save()
+        if current_app.config['MAIL_QUEUE_WORKER'] == 'thread':
+            self._start(current_app._get_current_object())
+            self._wake.set()
+        return message
+
+    def drain(self):
+        """Sends every due message, one batch at a time.
+        :return: counts of sent messages and of failed attempts
+        """
+        config = current_app.config
+        sent = failed = 0
+        while True:
+            batch = OutboxMessage.claim_due(config['MAIL_QUEUE_BATCH_SIZE'])
+            if not batch:
+                return sent, failed
+            pending = list(batch)
+            try:
+                with mail.connect() as connection:
+                    while pending:
+                        message = pending[0]
+                        try:
+                            connection.send(message.to_message())
+                        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+                            raise
+                        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                                smtplib.SMTPDataError) as e:
+                            # The server rejected this message only; SMTP
+                            # errors are OSErrors, so this comes first
+                            message.mark_failed(e, config['MAIL_MAX_ATTEMPTS'],
+                                                config['MAIL_RETRY_BACKOFF'])
+                            failed += 1
+                        except socket.error:
+                            raise
+                        except Exception as e:
+                            message.mark_failed(e, config['MAIL_MAX_ATTEMPTS'],
+                                                config['MAIL_RETRY_BACKOFF'])
+                            failed += 1
+                        else:
+                            message.mark_sent()
+                            sent += 1
+                        pending.pop(0)
+            except Exception as e:
+                # The connection failed; whatever was not sent is retried
+                logger.warning('Sending queued mail failed: %s', e)
+                for message in pending:
+                    message.mark_failed(e, config['MAIL_MAX_ATTEMPTS'],
+                                        config['MAIL_RETRY_BACKOFF'])
+                failed += len(pending)
+                db.session.commit()
+                return sent, failed
+            db.session.commit()
+
+    def run(self, app, stop=None):
+        """Drains the outbox until ``stop`` is set."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self.drain()
+                except Exception:
+                    logger.exception('Mail worker failed to drain the outbox')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            self._wake.wait(app.config['MAIL_QUEUE_POLL_SECONDS'])
+
+    def _start(self, app):
+        # One thread per process, started again in forked workers
+        with self._lock:
+            if self._thread is not None and self._thread_pid == os.getpid() \
+                    and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.run, args=(app,), name='mail-worker')
+            self._thread.daemon = True
+            self._thread.start()
+            self._thread_pid = os.getpid()
+
+
+mailer = Mailer()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""Metrics module, timing requests and their SQL statements per resource
+and serving the totals of every worker in the Prometheus text format.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import Response, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from code.cache import DEFAULT_RUNTIME_DIR, private_dir
+from code.pool import db_pool
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the statements per request buckets
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# Statements run by the request on this thread, as [count, seconds], or
+# None outside of requests
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - conn.info.pop('metrics_start', time.perf_counter())
+
+
+def request_queries():
+    """Statements run so far by the current request, as [count, seconds]."""
+    return getattr(_local, 'queries', None)
+
+
+class Histogram(object):
+    """Observation counts per bucket, with their sum."""
+
+    def __init__(self, buckets, counts=None, total=0.0):
+        self.buckets = buckets
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.total = total
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def merge(self, counts, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.total += total
+
+    def cumulative(self):
+        """(le, count) pairs, ending with +Inf."""
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            yield bound, running
+
+
+class Collector(object):
+    """The counters of one process."""
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.latency = {}
+        self.queries = defaultdict(int)
+        self.query_seconds = defaultdict(float)
+        self.queries_per_request = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, method, status, seconds, queries, query_seconds):
+        labels = (endpoint, method)
+        with self.lock:
+            self.requests[(endpoint, method, status)] += 1
+            latency = self.latency.get(labels)
+            if latency is None:
+                latency = self.latency[labels] = Histogram(LATENCY_BUCKETS)
+                self.queries_per_request[labels] = Histogram(QUERY_BUCKETS)
+            latency.observe(seconds)
+            self.queries_per_request[labels].observe(queries)
+            self.queries[labels] += queries
+            self.query_seconds[labels] += query_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': [list(key) + [value] for key, value in self.requests.items()],
+                'latency': [list(key) + [h.counts, h.total] for key, h in self.latency.items()],
+                'queries_per_request': [list(key) + [h.counts, h.total]
+                                        for key, h in self.queries_per_request.items()],
+                'queries': [list(key) + [value] for key, value in self.queries.items()],
+                'query_seconds': [list(key) + [value] for key, value in self.query_seconds.items()],
+            }
+
+
+def merge(snapshots):
+    """Sums the snapshots of several processes into one collector."""
+    total = Collector()
+    for snapshot in snapshots:
+        for endpoint, method, status, value in snapshot['requests']:
+            total.requests[(endpoint, method, status)] += value
+        for name, buckets in (('latency', LATENCY_BUCKETS), ('queries_per_request', QUERY_BUCKETS)):
+            histograms = getattr(total, name)
+            for endpoint, method, counts, value in snapshot[name]:
+                histograms.setdefault((endpoint, method), Histogram(buckets)).merge(counts, value)
+        for name in ('queries', 'query_seconds'):
+            counters = getattr(total, name)
+            for endpoint, method, value in snapshot[name]:
+                counters[(endpoint, method)] += value
+    return total
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def labels(**values):
+    return '{' + ','.join('{}="{}"'.format(name, escape(value))
+                          for name, value in sorted(values.items())) + '}'
+
+
+def render(collector, gauges=()):
+    """The Prometheus text exposition of a collector and of extra
+    ``(name, help, labels, value)`` gauges.
+    """
+    lines = []
+
+    def header(name, kind, help):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} {}'.format(name, kind))
+
+    header('http_requests_total', 'counter', 'Requests by resource, method and status.')
+    for (endpoint, method, status), value in sorted(collector.requests.items()):
+        lines.append('http_requests_total{} {}'.format(
+            labels(endpoint=endpoint, method=method, status=status), value))
+    for name, help, histograms in (
+            ('http_request_duration_seconds', 'Request latency by resource and method.',
+             collector.latency),
+            ('db_queries_per_request', 'SQL statements per request by resource and method.',
+             collector.queries_per_request)):
+        header(name, 'histogram', help)
+        for (endpoint, method), histogram in sorted(histograms.items()):
+            count = 0
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(name, labels(
+                    endpoint=endpoint, method=method, le='+Inf' if bound == float('inf') else bound),
+                    count))
+            lines.append('{}_sum{} {}'.format(name, labels(endpoint=endpoint, method=method),
+                                              histogram.total))
+            lines.append('{}_count{} {}'.format(name, labels(endpoint=endpoint, method=method),
+                                                count))
+    for name, help, counters in (
+            ('db_queries_total', 'SQL statements by resource and method.', collector.queries),
+            ('db_query_duration_seconds_total', 'Time spent in SQL statements by resource and method.',
+             collector.query_seconds)):
+        header(name, 'counter', help)
+        for (endpoint, method), value in sorted(counters.items()):
+            lines.append('{}{} {}'.format(name, labels(endpoint=endpoint, method=method), value))
+    seen = set()
+    for name, help, gauge_labels, value in gauges:
+        if name not in seen:
+            header(name, 'gauge', help)
+            seen.add(name)
+        lines.append('{}{} {}'.format(name, labels(**gauge_labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_metrics(directory):
+    """Removes the counter files of every worker, for when the service
+    starts; see ``gunicorn.conf.py``.
+    """
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Metrics(object):
+    """Records the latency, status and SQL statements of every request per
+    resource and method, and serves them at ``METRICS_PATH``.
+
+    Each worker keeps its own counters and writes them to a file of its own
+    in ``METRICS_DIR`` at most every ``METRICS_FLUSH_SECONDS``; the endpoint
+    adds up the files of all workers. Files are named after the worker's pid
+    and a random id, so a new worker reusing a pid does not overwrite an
+    old one's counters; ``clear_metrics`` empties the directory when the
+    service starts. ``METRICS_TOKEN`` is required as a bearer token when
+    set; with ``METRICS_REQUIRE_TOKEN`` the endpoint answers 401 until it is.
+    """
+
+    def __init__(self, app=None):
+        self.collector = Collector()
+        self._worker = None
+        self._flushed = 0
+        self._flush_lock = threading.Lock()
+        self._exit_dirs = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_PATH', '/metrics')
+        app.config.setdefault('METRICS_DIR', os.path.join(DEFAULT_RUNTIME_DIR, 'metrics'))
+        app.config.setdefault('METRICS_FLUSH_SECONDS', 5)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_REQUIRE_TOKEN', True)
+        if not app.config['METRICS_ENABLED']:
+            return
+        private_dir(app.config['METRICS_DIR'])
+        if app.config['METRICS_REQUIRE_TOKEN'] and not app.config['METRICS_TOKEN']:
+            logger.warning('METRICS_TOKEN is not set, %s will answer 401', app.config['METRICS_PATH'])
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule(app.config['METRICS_PATH'], 'metrics', self.view)
+        if app.config['METRICS_DIR'] not in self._exit_dirs:
+            self._exit_dirs.add(app.config['METRICS_DIR'])
+            atexit.register(self.flush, app.config['METRICS_DIR'])
+
+    def before_request(self):
+        _local.start = time.perf_counter()
+        _local.queries = [0, 0.0]
+
+    def after_request(self, response):
+        queries = getattr(_local, 'queries', None)
+        if queries is None:
+            return response
+        self.collector.record(request.endpoint or 'none', request.method, response.status_code,
+                              time.perf_counter() - _local.start, queries[0], queries[1])
+        if time.time() - self._flushed > current_app.config['METRICS_FLUSH_SECONDS']:
+            self.flush(current_app.config['METRICS_DIR'])
+        return response
+
+    def teardown_request(self, exc=None):
+        _local.queries = None
+
+    def path(self, directory):
+        # A new id in every process, forked workers included
+        if self._worker is None or self._worker[0] != os.getpid():
+            self._worker = (os.getpid(), uuid.uuid4().hex[:12])
+        return os.path.join(directory, '{}-{}.json'.format(*self._worker))
+
+    def flush(self, directory):
+        """Writes this worker's counters to its file."""
+        with self._flush_lock:
+            self._flushed = time.time()
+            path = self.path(directory)
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.collector.snapshot(), f)
+                os.replace(path + '.tmp', path)
+            except (IOError, OSError) as e:
+                logger.warning('Could not write metrics to %s: %s', path, e)
+
+    def snapshots(self, directory):
+        """The counters of every worker, this one's being current."""
+        own = self.path(directory)
+        snapshots = [self.collector.snapshot()]
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (IOError, OSError, ValueError):
+                continue
+        return snapshots
+
+    def gauges(self):
+        stats = db_pool.stats()
+        if stats is None:
+            return []
+        pid = { 'pid': os.getpid() }
+        return [
+            ('db_pool_checked_out', 'Connections checked out of this worker\'s pool.',
+             pid, stats['checked_out']),
+            ('db_pool_utilization', 'Share of this worker\'s pool capacity in use.',
+             pid, stats['utilization']),
+            ('db_pool_checkout_wait_seconds_total', 'Time this worker waited for connections.',
+             pid, stats['wait_seconds_total']),
+            ('db_pool_checkout_timeouts_total', 'Checkouts of this worker that timed out.',
+             pid, stats['timeouts']),
+        ]
+
+    def view(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token:
+            authorized = request.headers.get('Authorization') == 'Bearer ' + token
+        else:
+            authorized = not current_app.config['METRICS_REQUIRE_TOKEN']
+        if not authorized:
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+        collector = merge(self.snapshots(current_app.config['METRICS_DIR']))
+        return Response(render(collector, self.gauges()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+metrics = Metrics()
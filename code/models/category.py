@@ -6,6 +6,9 @@ from code.database import (
     db,
     Model,
     SurrogatePK,
+    SearchableMixin,
+    create_search_index,
+    unique_per_owner,
     relationship,
     ReferenceCol,
 )
@@ -13,8 +16,10 @@ from code.database import (
 from .recipe import Recipe
 
 
-class Category(SurrogatePK, Model):
+class Category(SurrogatePK, SearchableMixin, Model):
     __tablename__ = 'categories'
+    __searchable__ = ('title', 'description')
+    __owner__ = 'user_id'
     # Define a foreign key relationship to a User object
     user_id = ReferenceCol('users')
     title = db.Column(db.String(100), nullable=False)
@@ -30,12 +35,46 @@ class Category(SurrogatePK, Model):
         self.modified_at = datetime.datetime.now()
 
     @classmethod
-    def get_by_title(cls, title):
-        return cls.query.filter_by(title=title).first()
+    def get_by_title(cls, title, user_id):
+        return cls.query.filter_by(user_id=user_id, title=title).first()
 
     @classmethod
     def get_user_all(cls, user_id):
         return cls.query.filter_by(user_id=user_id)
 
+    @classmethod
+    def category_exists(cls, user_id, title):
+        query = cls.query.filter_by(user_id=user_id, title=title)
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def include_recipes(cls, categories, limit):
+        """
+        Sets ``included_recipes`` on each category to its first ``limit``
+        recipes, loading them for all categories in one query.
+        """
+        by_id = {}
+        for category in categories:
+            category.included_recipes = []
+            by_id[category.id] = category
+        if not by_id or not limit:
+            return
+        rank = db.func.row_number().over(partition_by=Recipe.category_id, order_by=Recipe.id)
+        ranked = db.session.query(Recipe.id.label('id'), rank.label('rank')) \
+            .filter(Recipe.category_id.in_(by_id)).subquery()
+        recipes = Recipe.query.join(ranked, ranked.c.id == Recipe.id) \
+            .filter(ranked.c.rank <= limit).order_by(Recipe.category_id, Recipe.id)
+        for recipe in recipes:
+            by_id[recipe.category_id].included_recipes.append(recipe)
+
+    @classmethod
+    def delete_children(cls, ids):
+        Recipe.query.filter(Recipe.category_id.in_(ids)).delete(synchronize_session=False)
+        return [(Recipe, category_id) for category_id in ids]
+
     def __repr__(self):  # pragma: nocover
         return '<Category({title!r})>'.format(title=self.title)
+
+
+create_search_index(Category)
+unique_per_owner(Category, 'title')
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import datetime
+
+from flask_mail import Message
+
+from code.database import (
+    db,
+    Model,
+    SurrogatePK,
+)
+
+
+class OutboxMessage(SurrogatePK, Model):
+    """
+    Outbound email waiting in the outbox for the mail worker
+    """
+
+    __tablename__ = 'outbox'
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(256), nullable=False)
+    # Comma separated addresses
+    recipients = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    # 'pending' until sent, or 'failed' once out of attempts
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime(256), nullable=False, index=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(256), nullable=False)
+    sent_at = db.Column(db.DateTime(256), nullable=True)
+
+    def __init__(self, subject, sender, recipients, html, **kwargs):
+        db.Model.__init__(self, subject=subject, sender=sender,
+                          recipients=','.join(recipients), html=html, **kwargs)
+        self.status = 'pending'
+        self.attempts = 0
+        self.created_at = datetime.datetime.now()
+        self.next_attempt_at = self.created_at
+
+    def to_message(self):
+        message = Message(self.subject, sender=self.sender, recipients=self.recipients.split(','))
+        message.html = self.html
+        return message
+
+    def mark_sent(self):
+        self.status = 'sent'
+        self.attempts += 1
+        self.sent_at = datetime.datetime.now()
+        self.last_error = None
+
+    def mark_failed(self, error, max_attempts, backoff):
+        """
+        Records a failed attempt and schedules the next one, doubling the
+        delay each time, or gives up after ``max_attempts``.
+        """
+        self.attempts += 1
+        self.last_error = str(error)
+        if self.attempts >= max_attempts:
+            self.status = 'failed'
+            return
+        delay = min(backoff * 2 ** (self.attempts - 1), 3600)
+        self.next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+    @classmethod
+    def claim_due(cls, limit):
+        """
+        Locks the next pending messages that are due, skipping those other
+        workers hold.
+        """
+        return cls.query.filter(cls.status == 'pending',
+                                cls.next_attempt_at <= datetime.datetime.now()) \
+            .order_by(cls.id).limit(limit).with_for_update(skip_locked=True).all()
+
+    def __repr__(self):  # pragma: nocover
+        return '<OutboxMessage({id}, {status})>'.format(id=self.id, status=self.status)
@@ -6,12 +6,17 @@ from code.database import (
     db,
     Model,
     SurrogatePK,
+    SearchableMixin,
+    create_search_index,
+    unique_per_owner,
     ReferenceCol,
 )
 
 
-class Recipe(SurrogatePK, Model):
+class Recipe(SurrogatePK, SearchableMixin, Model):
     __tablename__ = 'recipes'
+    __searchable__ = ('title', 'description')
+    __owner__ = 'category_id'
     # Define a foreign key relationship to a Category object
     category_id = ReferenceCol('categories')
     title = db.Column(db.String(100), nullable=False)
@@ -34,11 +39,9 @@ class Recipe(SurrogatePK, Model):
 
     @classmethod
     def recipe_exists(cls, category_id, title):
-        recipes = cls.query.filter_by(category_id=category_id)
-        recipeslist = []
-        for recipe in recipes:
-            recipeslist.append(recipe.title)
-        if title in recipeslist:
-            return True
-        else:
-            return False 
+        query = cls.query.filter_by(category_id=category_id, title=title)
+        return db.session.query(query.exists()).scalar()
+
+
+create_search_index(Recipe)
+unique_per_owner(Recipe, 'title')
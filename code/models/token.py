@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 
 from code.database import (
     db,
@@ -8,23 +9,48 @@ from code.database import (
 
 class Token(SurrogatePK, Model):
     """
-    Token Model for storing JWT tokens
+    Token Model for storing revoked JWT tokens by their id
     """
 
     __tablename__ = 'tokens'
-    token = db.Column(db.String(500), unique=True, nullable=False)
-    banned_on = db.Column(db.DateTime(256), nullable=False)
+    jti = db.Column(db.String(32), unique=True, nullable=False)
+    banned_on = db.Column(db.DateTime(256), nullable=False, index=True)
+    # When the token would have expired anyway, in UTC
+    expires_at = db.Column(db.DateTime(256), nullable=False, index=True)
 
-    def __init__(self, token, **kwargs):
-        db.Model.__init__(self, token = token, **kwargs)
+    def __init__(self, jti, expires_at, **kwargs):
+        db.Model.__init__(self, jti=jti, expires_at=expires_at, **kwargs)
         self.banned_on = datetime.datetime.now()
 
+    @staticmethod
+    def key_for(payload, auth_token):
+        """
+        Revocation key of a token: its ``jti`` claim, or a digest of the
+        token for tokens issued without one.
+        """
+        if payload.get('jti'):
+            return payload['jti']
+        if not isinstance(auth_token, bytes):
+            auth_token = auth_token.encode('utf-8')
+        return hashlib.sha256(auth_token).hexdigest()[:32]
+
     @classmethod
-    def check_banned(cls, auth_token):
-        res = cls.query.filter_by(token=auth_token).first()
+    def check_banned(cls, jti):
+        res = cls.query.filter_by(jti=jti).first()
         if res:
             return True
         return False
 
+    @classmethod
+    def purge_expired(cls, now=None):
+        """
+        Deletes revocations of tokens that have expired by now
+        :return: number of deleted rows
+        """
+        now = now or datetime.datetime.utcnow()
+        count = cls.query.filter(cls.expires_at < now).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
     def __repr__(self):  # pragma: nocover
-        return '<Token({token})>'.format(token=self.token)
+        return '<Token({jti})>'.format(jti=self.jti)
@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 
 import datetime
+import uuid
 import jwt
 from flask import current_app as app
-from werkzeug.security import generate_password_hash, check_password_hash
 from code.database import (
     db,
     Model,
     SurrogatePK,
     relationship,
 )
+from code.passwords import passwords
+from code.revocation import revocations
 from .category import Category
-from .token import Token
+
+# How long auth tokens stay valid
+TOKEN_LIFETIME = datetime.timedelta(days=2)
 
 
 class User(SurrogatePK, Model):
@@ -23,13 +27,16 @@ class User(SurrogatePK, Model):
     last_name = db.Column(db.String(50), nullable=True)
     created_at = db.Column(db.DateTime(256), nullable=False)
     modified_at = db.Column(db.DateTime(256), nullable=False)
+    # Bumped whenever previously issued auth tokens must stop working
+    credential_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     categories = relationship(Category, cascade="all, delete-orphan", backref=db.backref('user'))
 
     def __init__(self, username, email, password, **kwargs):
+        # Hashes the password once, through the password setter
         db.Model.__init__(self, username=username, email=email,
                           password=password, **kwargs)
-        self.set_password(password)
+        self.credential_version = 0
         self.created_at = datetime.datetime.now()
         self.modified_at = datetime.datetime.now()
 
@@ -42,10 +49,30 @@ class User(SurrogatePK, Model):
         self.set_password(password)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        if self.password_hash is not None:
+            self.revoke_credentials()
+        self.password_hash = passwords.hash(password)
+
+    def revoke_credentials(self):
+        """Invalidate every auth token issued to this user so far."""
+        self.credential_version = (self.credential_version or 0) + 1
+        self.modified_at = datetime.datetime.now()
+        if self.id is not None:
+            revocations.note_version(self.id, self.credential_version)
 
     def check_password(self, value):
-        return check_password_hash(self.password_hash, value)
+        return passwords.verify(self.password_hash, value)
+
+    def upgrade_password_hash(self, password):
+        """
+        Rehash a verified password whose hash was made with other parameters
+        than the current ones. Issued tokens stay valid.
+        :return: whether the hash changed
+        """
+        if not passwords.needs_rehash(self.password_hash):
+            return False
+        self.password_hash = passwords.hash(password)
+        return True
 
     @property
     def full_name(self):
@@ -66,9 +93,12 @@ class User(SurrogatePK, Model):
         """
         try:
             payload = {
-                'exp': datetime.datetime.utcnow() + datetime.timedelta(days=2),
+                'exp': datetime.datetime.utcnow() + TOKEN_LIFETIME,
                 'iat': datetime.datetime.utcnow(),
-                'sub': user_id
+                'sub': user_id,
+                'jti': uuid.uuid4().hex,
+                'username': self.username,
+                'ver': self.credential_version or 0
             }
             return jwt.encode(
                 payload,
@@ -104,18 +134,35 @@ class User(SurrogatePK, Model):
         :param auth_token:
         :return: integer|string
         """
+        claims = User.decode_auth_claims(auth_token)
+        if isinstance(claims, str):
+            return claims
+        return claims['sub']
+
+    @staticmethod
+    def decode_auth_claims(auth_token):
+        """
+        Validates the auth token and returns all of its claims
+        :param auth_token:
+        :return: dict|string
+        """
         try:
             payload = jwt.decode(auth_token,
                                  app.config['SECRET_KEY'],
                                  algorithms='HS256')
-            is_banned_token = Token.check_banned(auth_token)
+            is_banned_token = revocations.is_revoked(payload, auth_token)
             if is_banned_token:
                 return 'Banned Token. Please sign in again.'
-            return payload['sub']
+            return payload
         except jwt.ExpiredSignatureError:
             return 'Expired Signature. Please log in again.'
         except jwt.InvalidTokenError:
             return 'Invalid token. Please log in again.'
 
+    def delete(self, commit=True):
+        """Remove the user and stop honouring their tokens in every worker."""
+        revocations.forget_user(self.id, datetime.datetime.utcnow() + TOKEN_LIFETIME)
+        return Model.delete(self, commit)
+
     def __repr__(self):  # pragma: nocover
         return '<User({username!r})>'.format(username=self.username)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Passwords module, hashing and checking passwords on a process pool so a
+key derivation does not hold the worker's GIL while other requests wait.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import abort, current_app, jsonify, make_response
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+    """Hashes passwords with ``PASSWORD_HASH_METHOD`` on a pool of
+    ``PASSWORD_HASH_WORKERS`` processes, or inline when that is 0.
+
+    The pool is started on first use in each process, so forked gunicorn
+    workers get their own, and at most ``PASSWORD_HASH_WORKERS`` jobs per
+    process are queued on it at a time. A hash that takes longer than
+    ``PASSWORD_HASH_TIMEOUT`` answers 503 with ``Retry-After``.
+    """
+
+    def __init__(self, app=None):
+        self._pool = None
+        self._pool_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+        app.config.setdefault('PASSWORD_SALT_LENGTH', 16)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 30)
+
+    def _executor(self, workers):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(max_workers=workers)
+                self._pool_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(workers)
+            return self._pool, self._slots
+
+    def _run(self, func, *args):
+        config = current_app.config
+        workers = config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return func(*args)
+        pool, slots = self._executor(workers)
+        with slots:
+            try:
+                return pool.submit(func, *args).result(timeout=config['PASSWORD_HASH_TIMEOUT'])
+            except TimeoutError:
+                result = { 'message': 'Server is busy. Please try again later.' }
+                response = make_response(jsonify(result), 503)
+                response.headers['Retry-After'] = str(config['PASSWORD_HASH_TIMEOUT'])
+                abort(response)
+            except BrokenProcessPool:
+                with self._lock:
+                    self._pool = None
+                return func(*args)
+
+    def hash(self, password):
+        config = current_app.config
+        return self._run(generate_password_hash, password,
+                         config['PASSWORD_HASH_METHOD'], config['PASSWORD_SALT_LENGTH'])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether a hash was made with other parameters than the current
+        ones. A method without a cost, like ``pbkdf2:sha256``, accepts any.
+        """
+        config = current_app.config
+        if pwhash.count('$') < 2:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        wanted = config['PASSWORD_HASH_METHOD'].split(':')
+        return (method.split(':')[:len(wanted)] != wanted
+                or len(salt) != config['PASSWORD_SALT_LENGTH'])
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""Pool module, configuring the database connection pool from the ``DB_*``
+settings and keeping statistics on how it is used.
+"""
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from code.extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats(object):
+    """Checkout counters of one pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += int(timed_out)
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that measures how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            connection = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self.stats.record(time.time() - start, timed_out=True)
+            raise
+        self.stats.record(time.time() - start)
+        return connection
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    # A connection inherited through fork belongs to the parent: drop it
+    # without closing it, and let the pool open a new one
+    if connection_record.info.get('pid') != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to process {}'.format(
+            connection_record.info.get('pid')))
+
+
+def engine_options(config):
+    """Engine options for the ``DB_*`` settings. Only PostgreSQL gets a
+    pool; other databases keep SQLAlchemy's defaults.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    # Heroku's DATABASE_URL uses the older postgres:// scheme
+    if url.get_backend_name() not in ('postgresql', 'postgres'):
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+    if config['DB_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {
+            'options': '-c statement_timeout={:d}'.format(config['DB_STATEMENT_TIMEOUT'])}
+    return options
+
+
+class DatabasePool(object):
+    """Sets ``SQLALCHEMY_ENGINE_OPTIONS`` from the ``DB_*`` settings, which
+    options already in ``SQLALCHEMY_ENGINE_OPTIONS`` override, and opens
+    ``DB_POOL_WARM`` connections when the app is created.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DB_POOL_SIZE', 5)
+        app.config.setdefault('DB_MAX_OVERFLOW', 10)
+        app.config.setdefault('DB_POOL_TIMEOUT', 10)
+        app.config.setdefault('DB_POOL_RECYCLE', 1800)
+        app.config.setdefault('DB_POOL_PRE_PING', True)
+        app.config.setdefault('DB_STATEMENT_TIMEOUT', 0)
+        app.config.setdefault('DB_POOL_WARM', 0)
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+            engine_options(app.config), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    def warm(self, app):
+        """Opens the first connections of the pool so the first requests of
+        a worker do not pay for them.
+        """
+        count = app.config['DB_POOL_WARM']
+        if not count:
+            return
+        with app.app_context():
+            pool = db.engine.pool
+            if not isinstance(pool, TimedQueuePool):
+                return
+            connections = []
+            try:
+                for _ in range(min(count, pool.size())):
+                    connections.append(db.engine.connect())
+            except exc.SQLAlchemyError as e:
+                logger.warning('Could not warm the connection pool: %s', e)
+            finally:
+                for connection in connections:
+                    connection.close()
+
+    def stats(self):
+        """Utilization and checkout waits of the pool, or ``None`` when the
+        database is not pooled.
+        """
+        pool = db.get_engine(current_app).pool
+        if not isinstance(pool, TimedQueuePool):
+            return None
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        stats = pool.stats
+        return {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'utilization': float(pool.checkedout()) / capacity if capacity else 0.0,
+            'checkouts': stats.checkouts,
+            'timeouts': stats.timeouts,
+            'wait_seconds_total': stats.wait_total,
+            'wait_seconds_max': stats.wait_max,
+        }
+
+
+db_pool = DatabasePool()
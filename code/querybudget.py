@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Query budget module, counting the SQL statements of each request in
+development and tests, flagging repeated ones and failing requests that run
+more than their endpoint's budget.
+"""
+import atexit
+import logging
+import sys
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Statements run by the request on this thread, or None when not counting
+_local = threading.local()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    statements = getattr(_local, 'statements', None)
+    if statements is not None:
+        statements.append((statement, repr(parameters)))
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised in strict mode by requests running more statements than their
+    budget allows.
+    """
+
+
+def budget_for(budgets, endpoint, method):
+    """The budget of an endpoint, given as a number of statements for every
+    method or as a dict of them per method.
+    """
+    budget = budgets.get(endpoint)
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget
+
+
+def duplicate_count(statements):
+    """Statements run again with the same parameters."""
+    return len(statements) - len(set(statements))
+
+
+class EndpointReport(object):
+    """What the requests of one endpoint and method ran."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duplicates = 0
+        self.over_budget = 0
+        self.repeated = Counter()
+
+
+class QueryBudget(object):
+    """Counts the statements of every request when ``QUERY_BUDGET_ENABLED``.
+
+    Responses carry ``X-Query-Count`` and ``X-Query-Duplicates``, the number
+    of statements run again with the same parameters. ``QUERY_BUDGETS`` maps
+    endpoints to their budget; a request over it gets ``X-Query-Budget`` and
+    a warning, or raises ``QueryBudgetExceeded`` with
+    ``QUERY_BUDGET_STRICT``. With ``QUERY_BUDGET_REPORT`` a summary per
+    endpoint is written to stderr when the process exits.
+
+    Streamed bodies (``stream_with_context``) run statements after the
+    headers are sent: the headers and strict mode only cover the statements
+    run before, while the report and a warning at teardown count them all.
+    """
+
+    def __init__(self, app=None):
+        self.reports = defaultdict(EndpointReport)
+        self._lock = threading.Lock()
+        self._reporting = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('QUERY_BUDGET_ENABLED', False)
+        app.config.setdefault('QUERY_BUDGETS', {})
+        app.config.setdefault('QUERY_BUDGET_STRICT', False)
+        app.config.setdefault('QUERY_BUDGET_REPORT', False)
+        if not app.config['QUERY_BUDGET_ENABLED']:
+            return
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        if app.config['QUERY_BUDGET_REPORT'] and not self._reporting:
+            self._reporting = True
+            atexit.register(self.print_report)
+
+    def before_request(self):
+        _local.statements = []
+        _local.checked = 0
+
+    def budget(self):
+        return budget_for(current_app.config['QUERY_BUDGETS'], request.endpoint or 'none',
+                          request.method)
+
+    def message(self, count, budget):
+        return '{} {} ran {} SQL statements, over its budget of {}'.format(
+            request.method, request.endpoint or 'none', count, budget)
+
+    def after_request(self, response):
+        statements = getattr(_local, 'statements', None)
+        if statements is None:
+            return response
+        count = _local.checked = len(statements)
+        response.headers['X-Query-Count'] = str(count)
+        response.headers['X-Query-Duplicates'] = str(duplicate_count(statements))
+        budget = self.budget()
+        if budget is not None and count > budget:
+            if current_app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(self.message(count, budget))
+            logger.warning(self.message(count, budget))
+            response.headers['X-Query-Budget'] = 'exceeded'
+        return response
+
+    def teardown_request(self, exc=None):
+        # Runs once a streamed body is sent, so its statements are counted
+        statements = getattr(_local, 'statements', None)
+        if statements is None:
+            return
+        _local.statements = None
+        count = len(statements)
+        repeated = dict((statement, times) for statement, times in Counter(statements).items()
+                        if times > 1)
+        budget = self.budget()
+        over_budget = budget is not None and count > budget
+        with self._lock:
+            report = self.reports[(request.endpoint or 'none', request.method)]
+            report.requests += 1
+            report.queries += count
+            report.max_queries = max(report.max_queries, count)
+            report.duplicates += duplicate_count(statements)
+            report.over_budget += int(over_budget)
+            report.repeated.update(statement for statement, _ in repeated)
+        if over_budget and _local.checked <= budget:
+            logger.warning(self.message(count, budget) + ' while streaming its body')
+
+    def report(self):
+        """A summary of the statements run per endpoint and method."""
+        lines = ['{:<45} {:>8} {:>8} {:>6} {:>10} {:>11}'.format(
+            'endpoint', 'requests', 'avg', 'max', 'duplicates', 'over budget')]
+        with self._lock:
+            reports = sorted(self.reports.items())
+        for (endpoint, method), report in reports:
+            lines.append('{:<45} {:>8} {:>8.1f} {:>6} {:>10} {:>11}'.format(
+                '{} {}'.format(method, endpoint), report.requests,
+                float(report.queries) / report.requests, report.max_queries,
+                report.duplicates, report.over_budget))
+        repeated = Counter()
+        for report in dict(reports).values():
+            repeated.update(report.repeated)
+        if repeated:
+            lines.append('')
+            lines.append('Statements most often repeated within a request:')
+            for statement, requests in repeated.most_common(10):
+                lines.append('  {:>5} requests: {}'.format(requests, ' '.join(statement.split())))
+        return '\n'.join(lines)
+
+    def print_report(self):
+        if self.reports:
+            sys.stderr.write('\nSQL statements per request\n' + self.report() + '\n')
+
+
+query_budget = QueryBudget()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Rate limit module, throttling expensive endpoints with token buckets per
+client address and per account.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request
+
+from code.cache import DEFAULT_RUNTIME_DIR, private_dir
+
+
+def refill(tokens, updated, capacity, per, now):
+    """Tokens in a bucket that started at ``tokens`` at ``updated`` and
+    regains ``capacity`` tokens every ``per`` seconds.
+    """
+    return min(capacity, tokens + (now - updated) * capacity / per)
+
+
+def take_token(tokens, capacity, per):
+    """Takes one token; returns the tokens left and the seconds to wait
+    before retrying, or 0 when the token was taken.
+    """
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) * per / capacity
+
+
+class MemoryBuckets(object):
+    """Token buckets kept in this process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per):
+        now = time.time()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, per))
+            tokens, wait = take_token(refill(tokens, updated, capacity, per, now), capacity, per)
+            self._buckets[key] = (tokens, now, per)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets = {}
+
+    def _prune(self, now):
+        # Buckets idle for a whole period are full again, same as absent
+        self._buckets = dict((key, bucket) for key, bucket in self._buckets.items()
+                             if now - bucket[1] < bucket[2])
+
+
+class SQLiteBuckets(object):
+    """Token buckets kept in a SQLite file shared by the worker processes of
+    one host.
+    """
+
+    # Takes between two sweeps of idle buckets, per process
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path):
+        private_dir(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.takes = 0
+        self._local = threading.local()
+        self._db().execute('CREATE TABLE IF NOT EXISTS buckets '
+                           '(key TEXT PRIMARY KEY, tokens REAL, updated REAL, per REAL)')
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def take(self, key, capacity, per):
+        db, now = self._db(), time.time()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row is not None else (capacity, now)
+            tokens, wait = take_token(refill(tokens, updated, capacity, per, now), capacity, per)
+            db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)',
+                       (key, tokens, now, per))
+            self.takes += 1
+            if self.takes % self.PRUNE_EVERY == 0:
+                # Buckets idle for a whole period are full again, same as absent
+                db.execute('DELETE FROM buckets WHERE ? - updated >= per', (now,))
+        return wait
+
+    def clear(self):
+        self._db().execute('DELETE FROM buckets')
+
+
+BUCKET_BACKENDS = {
+    'memory': lambda config: MemoryBuckets(),
+    'sqlite': lambda config: SQLiteBuckets(config['RATE_LIMIT_PATH']),
+}
+
+
+def account_key():
+    """The account a request is about, from its JSON body."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None
+    account = data.get('email') or data.get('username')
+    return account.strip().lower() if isinstance(account, str) and account.strip() else None
+
+
+class RateLimiter(object):
+    """Throttles the endpoints listed in ``RATE_LIMITS``.
+
+    Each endpoint maps ``'ip'`` and ``'account'`` to ``(requests, seconds)``:
+    a bucket of ``requests`` tokens refilled over ``seconds``, per client
+    address and per email or username in the body. ``RATE_LIMIT_BACKEND`` is
+    ``'sqlite'``, the default, for buckets shared by the workers of one
+    host, ``'memory'`` for buckets per worker, which lets a client through
+    as many times as there are workers, or ``'none'``.
+
+    The client address is the one ``PROXY_FIX_X_FOR`` trusted proxies put
+    in ``X-Forwarded-For``, see ``create_app``.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_BACKEND', 'sqlite')
+        app.config.setdefault('RATE_LIMIT_PATH',
+                              os.path.join(DEFAULT_RUNTIME_DIR, 'rate-limits.sqlite'))
+        backend = BUCKET_BACKENDS.get(app.config['RATE_LIMIT_BACKEND'])
+        app.extensions['rate_limits'] = backend(app.config) if backend else None
+
+    def retry_after(self):
+        """Seconds the current request has to wait, or 0 if it may go on."""
+        buckets = current_app.extensions['rate_limits']
+        limits = current_app.config['RATE_LIMITS'].get(request.endpoint)
+        if buckets is None or not limits:
+            return 0
+        keys = [('ip', request.remote_addr)]
+        if 'account' in limits:
+            keys.append(('account', account_key()))
+        for scope, value in keys:
+            if scope not in limits or value is None:
+                continue
+            capacity, per = limits[scope]
+            wait = buckets.take('{}:{}:{}'.format(request.endpoint, scope, value), capacity, per)
+            if wait:
+                return wait
+        return 0
+
+
+rate_limiter = RateLimiter()
+
+
+def rate_limited(func):
+    """ Answers 429 with ``Retry-After`` when the endpoint's rate limits are
+    exceeded, before the decorated resource runs.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        wait = rate_limiter.retry_after()
+        if wait:
+            result = { 'message': 'Too many requests. Please try again later.' }
+            return result, 429, { 'Retry-After': str(int(math.ceil(wait))) }
+        return func(*args, **kwargs)
+    return wrapper
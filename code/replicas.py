@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Replicas module, sending the reads of marked GET endpoints to read
+replicas while writes, and the reads of users who just wrote, stay on the
+primary.
+"""
+import os
+import random
+from functools import wraps
+
+from flask import current_app, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+
+def writer_key(user_id):
+    return 'writer:{}'.format(user_id)
+
+
+def read_from_a_replica():
+    """Whether the current request read from a replica, whose rows may lag
+    behind the primary.
+    """
+    return has_request_context() and g.get('replica') is not None
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from a replica during requests that allow it, until
+    the request writes.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            if has_request_context():
+                g.db_wrote = True
+        elif has_request_context() and g.get('read_replica') and not g.get('db_wrote'):
+            replica = self._db.get_replica(self.app)
+            if replica is not None:
+                return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """``SQLAlchemy`` with optional read replicas.
+
+    ``SQLALCHEMY_REPLICA_URIS`` lists the replicas, which get the same engine
+    options as the primary. Endpoints decorated with ``read_from_replica``
+    read from one of them, picked at random per request, unless
+    ``DB_READ_FROM_REPLICAS`` is off or the user wrote in the last
+    ``DB_REPLICA_STICKY_SECONDS``. ``DB_REPLICA_STICKY_BACKEND`` keeps those
+    writes per worker (``'memory'``) or for the workers of one host
+    (``'sqlite'``).
+
+    Replica reads are not stored in the response or count caches, so a
+    lagging replica's rows are never served for longer than the lag.
+    """
+
+    def init_app(self, app):
+        from code.cache import DEFAULT_RUNTIME_DIR, MemoryCache, SQLiteCache
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('DB_READ_FROM_REPLICAS', True)
+        app.config.setdefault('DB_REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('DB_REPLICA_STICKY_BACKEND', 'sqlite')
+        app.config.setdefault('DB_REPLICA_STICKY_PATH',
+                              os.path.join(DEFAULT_RUNTIME_DIR, 'replica-writers.sqlite'))
+        app.config.setdefault('DB_REPLICA_STICKY_MAX_ENTRIES', 100000)
+        SQLAlchemy.init_app(self, app)
+        app.extensions['replica_engines'] = None
+        app.extensions['replica_writers'] = None
+        if app.config['SQLALCHEMY_REPLICA_URIS']:
+            ttl = app.config['DB_REPLICA_STICKY_SECONDS']
+            max_entries = app.config['DB_REPLICA_STICKY_MAX_ENTRIES']
+            if app.config['DB_REPLICA_STICKY_BACKEND'] == 'sqlite':
+                writers = SQLiteCache(app.config['DB_REPLICA_STICKY_PATH'],
+                                      max_entries=max_entries, ttl=ttl)
+            else:
+                writers = MemoryCache(max_entries=max_entries, ttl=ttl)
+            app.extensions['replica_writers'] = writers
+            app.after_request(self._remember_writer)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replicas(self, app=None):
+        """The replica engines, created on first use."""
+        app = self.get_app(app)
+        with self._engine_lock:
+            engines = app.extensions['replica_engines']
+            if engines is None:
+                engines = app.extensions['replica_engines'] = [
+                    self._create_replica(app, uri) for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
+            return engines
+
+    def _create_replica(self, app, uri):
+        options = self.apply_pool_defaults(app, {})
+        sa_url, options = self.apply_driver_hacks(app, make_url(uri), options)
+        options.update(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        options.update(self._engine_options)
+        return self.create_engine(sa_url, options)
+
+    def get_replica(self, app=None):
+        """The replica the current request reads from, or ``None`` for the
+        primary.
+        """
+        app = self.get_app(app)
+        if not app.config['DB_READ_FROM_REPLICAS'] or not app.config['SQLALCHEMY_REPLICA_URIS']:
+            return None
+        if 'replica' not in g:
+            g.replica = random.choice(self.get_replicas(app))
+        return g.replica
+
+    def wrote_recently(self, user_id):
+        writers = current_app.extensions.get('replica_writers')
+        return writers is not None and writers.get(writer_key(user_id)) is not None
+
+    def _remember_writer(self, response):
+        user = g.get('user')
+        if g.get('db_wrote') and user is not None:
+            current_app.extensions['replica_writers'].set(writer_key(user.id), True)
+        return response
+
+
+def read_from_replica(func):
+    """ Lets the decorated resource read from a replica, unless the current
+    user wrote recently.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        db = current_app.extensions['sqlalchemy'].db
+        user = g.get('user')
+        g.read_replica = user is None or not db.wrote_recently(user.id)
+        return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Revocation module, caching banned auth tokens and user credential
+versions in each worker so that authenticated requests do not query the
+tokens or users tables.
+"""
+import datetime
+import hashlib
+import threading
+import time
+
+from flask import current_app
+
+from code.extensions import db
+from code.models.token import Token
+
+
+def token_digest(jti):
+    """Short digest used as the in-memory key for a revoked token."""
+    return hashlib.sha256(jti.encode('utf-8')).digest()[:8]
+
+
+# Prefix of the revocation rows recording deleted users, whose tokens no
+# jti or digest can collide with
+DELETED_USER_PREFIX = 'user:'
+
+
+class _RevocationState(object):
+    """Per-application revocation state."""
+
+    def __init__(self):
+        self.digests = {}
+        self.watermark = None
+        self.versions = {}
+        self.user_watermark = None
+        self.loaded = False
+        self.refreshed_at = 0.0
+        self.lock = threading.Lock()
+
+
+class RevocationCache(object):
+    """Banned token digests, loaded once per worker and refreshed
+    incrementally from ``tokens.banned_on``. Entries are dropped once the
+    token they ban has expired.
+
+    A miss is a definite "not banned" and costs no database round trip. A hit
+    is confirmed against the tokens table, so digest collisions can never ban
+    a valid token.
+
+    ``banned_on`` is stamped before the ban commits, so bans committed out of
+    order can land behind the watermark. Each refresh therefore re-reads the
+    last ``REVOCATION_REFRESH_OVERLAP`` seconds before it.
+
+    The credential versions of users that revoked their tokens are tracked
+    the same way, from ``users.modified_at``, for the stateless auth path.
+    Deleted users leave no row to read, so their deletion is recorded as a
+    revocation row instead, until their last token has expired.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REVOCATION_REFRESH_SECONDS', 30)
+        app.config.setdefault('REVOCATION_REFRESH_OVERLAP', 60)
+        app.extensions['revocations'] = _RevocationState()
+
+    @property
+    def _state(self):
+        return current_app.extensions['revocations']
+
+    def refresh(self, force=False):
+        """Pull tokens banned since the last refresh, at most once per
+        ``REVOCATION_REFRESH_SECONDS``.
+        """
+        state = self._state
+        interval = current_app.config['REVOCATION_REFRESH_SECONDS']
+        if not force and state.loaded and time.time() - state.refreshed_at < interval:
+            return
+        with state.lock:
+            if not force and state.loaded and time.time() - state.refreshed_at < interval:
+                return
+            now = datetime.datetime.utcnow()
+            query = db.session.query(Token.jti, Token.banned_on, Token.expires_at)
+            query = query.filter(Token.expires_at > now)
+            if state.watermark is not None:
+                # Rows stamped within the overlap are re-read; adding a
+                # digest twice is harmless.
+                query = query.filter(Token.banned_on >= state.watermark - self._overlap())
+            for jti, banned_on, expires_at in query:
+                if jti.startswith(DELETED_USER_PREFIX):
+                    state.versions[int(jti[len(DELETED_USER_PREFIX):])] = None
+                else:
+                    state.digests[token_digest(jti)] = expires_at
+                if state.watermark is None or banned_on > state.watermark:
+                    state.watermark = banned_on
+            state.digests = dict(
+                (digest, expires_at) for digest, expires_at in state.digests.items()
+                if expires_at > now)
+            self._refresh_versions(state)
+            state.loaded = True
+            state.refreshed_at = time.time()
+
+    def _overlap(self):
+        return datetime.timedelta(seconds=current_app.config['REVOCATION_REFRESH_OVERLAP'])
+
+    def _refresh_versions(self, state):
+        # Imported here as the user model itself depends on this module
+        from code.models.user import User
+
+        query = db.session.query(User.id, User.credential_version, User.modified_at)
+        if state.user_watermark is None:
+            # Users that never revoked anything are implicitly at version 0
+            latest = db.session.query(db.func.max(User.modified_at)).scalar()
+            query = query.filter(User.credential_version > 0)
+        else:
+            latest = state.user_watermark
+            # Same overlap as the bans, for changes committed out of order
+            query = query.filter(User.modified_at >= state.user_watermark - self._overlap())
+        for user_id, version, modified_at in query:
+            state.versions[user_id] = version
+            if latest is None or modified_at > latest:
+                latest = modified_at
+        state.user_watermark = latest
+
+    def credential_version(self, user_id):
+        """Last known credential version of a user, or ``None`` once the
+        user has been deleted.
+        """
+        self.refresh()
+        return self._state.versions.get(user_id, 0)
+
+    def note_version(self, user_id, version):
+        """Make a credential version bump visible to this worker at once."""
+        self._state.versions[user_id] = version
+
+    def forget_user(self, user_id, expires_at):
+        """Stop vouching for a deleted user's tokens, issued until
+        ``expires_at``, in every worker. The record is committed with the
+        deletion.
+        """
+        db.session.add(Token(DELETED_USER_PREFIX + str(user_id), expires_at))
+        self._state.versions[user_id] = None
+
+    def is_revoked(self, payload, auth_token):
+        """Check whether a decoded token has been banned."""
+        self.refresh()
+        jti = Token.key_for(payload, auth_token)
+        if token_digest(jti) not in self._state.digests:
+            return False
+        return Token.check_banned(jti)
+
+    def revoke(self, payload, auth_token):
+        """Ban a decoded token until it expires and make the ban visible to
+        this worker immediately.
+        """
+        expires_at = datetime.datetime.utcfromtimestamp(payload['exp'])
+        token = Token(Token.key_for(payload, auth_token), expires_at)
+        token.save()
+        self._state.digests[token_digest(token.jti)] = expires_at
+        return token
+
+
+revocations = RevocationCache()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Serializers module, compiling Flask-RESTful field maps into functions.
+
+``marshal`` walks a field map and resolves each field on every object of
+every response. ``compile_fields`` does that walk once and returns a function
+that produces the same output as ``marshal`` for the same map, so the two can
+be swapped freely.
+"""
+from functools import wraps
+
+from flask import abort, current_app, g, make_response, request
+from flask_restful import fields
+from flask_restful.fields import get_value, is_indexable_but_not_string
+from flask_restful.representations.json import output_json as restful_output_json
+from flask_restful.utils import unpack
+from werkzeug.wrappers import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None
+
+_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def rfc822(dt):
+    """``fields.DateTime`` formatting, without the round trip through a
+    timestamp that ``email.utils.formatdate`` takes.
+    """
+    t = dt.utctimetuple()
+    return '%s, %02d %s %04d %02d:%02d:%02d -0000' % (
+        _DAYS[t.tm_wday], t.tm_mday, _MONTHS[t.tm_mon - 1], t.tm_year,
+        t.tm_hour, t.tm_min, t.tm_sec)
+
+
+def make_getter(key):
+    """Compiled ``fields.get_value`` for one key."""
+    if not isinstance(key, str) or '.' in key:
+        return lambda obj: get_value(key, obj)
+
+    def getter(obj):
+        if type(obj) is dict:
+            if key in obj:
+                return obj[key]
+        elif is_indexable_but_not_string(obj):
+            return get_value(key, obj)
+        return getattr(obj, key, None)
+    return getter
+
+
+def formatted(getter, default, format):
+    def output(obj):
+        value = getter(obj)
+        return default if value is None else format(value)
+    return output
+
+
+def compile_nested(field, getter):
+    serialize = compile_fields(field.nested)
+    allow_null, default = field.allow_null, field.default
+
+    def output_value(value):
+        if value is None:
+            if allow_null:
+                return None
+            if default is not None:
+                return default
+        if isinstance(value, (list, tuple)):
+            return [serialize(item) for item in value]
+        return serialize(value)
+    return output_value if getter is None else (lambda obj: output_value(getter(obj)))
+
+
+def compile_list(field, getter):
+    container = field.container
+    if type(container) is not fields.Nested:
+        return None
+    serialize = compile_fields(container.nested)
+    item = compile_nested(container, None)
+    default = field.default
+
+    def output(obj):
+        value = getter(obj)
+        if is_indexable_but_not_string(value) and not isinstance(value, dict):
+            return [item(element) for element in value]
+        if value is None:
+            return default
+        return [serialize(value)]
+    return output
+
+
+def compile_field(key, field):
+    """A function of one object returning ``field.output(key, obj)``."""
+    if isinstance(field, dict):
+        return compile_fields(field)
+    if isinstance(field, type):
+        field = field()
+    kind = type(field)
+    getter = make_getter(key if field.attribute is None else field.attribute)
+    if kind is fields.String:
+        return formatted(getter, field.default, str)
+    if kind is fields.Integer:
+        return formatted(getter, field.default, int)
+    if kind is fields.Boolean:
+        return formatted(getter, field.default, bool)
+    if kind is fields.Raw:
+        return formatted(getter, field.default, lambda value: value)
+    if kind is fields.DateTime and field.dt_format == 'rfc822':
+        return formatted(getter, field.default, rfc822)
+    if kind is fields.Nested:
+        return compile_nested(field, getter)
+    if kind is fields.List:
+        output = compile_list(field, getter)
+        if output is not None:
+            return output
+    # Anything else keeps its own output method
+    return lambda obj: field.output(key, obj)
+
+
+def compile_fields(field_map):
+    """Compiles a field map into a function equivalent to
+    ``lambda obj: marshal(obj, field_map)``.
+    """
+    compiled = [(key, compile_field(key, field)) for key, field in field_map.items()]
+
+    def serialize(obj):
+        if isinstance(obj, (list, tuple)):
+            return [serialize(item) for item in obj]
+        return dict([(key, output(obj)) for key, output in compiled])
+    return serialize
+
+
+def item_fields(field_map):
+    """The field map of the items a map serializes: that of a page's
+    ``items``, or the map itself.
+    """
+    items = field_map.get('items')
+    if isinstance(items, fields.List) and isinstance(items.container, fields.Nested):
+        return items.container.nested
+    return field_map
+
+
+def replace_items(field_map, items):
+    """A copy of ``field_map`` serializing its items with ``items``."""
+    if item_fields(field_map) is field_map:
+        return items
+    return dict(field_map, items=fields.List(fields.Nested(items)))
+
+
+def project(field_map, names):
+    """A copy of ``field_map`` whose items only keep the ``names`` fields."""
+    items = item_fields(field_map)
+    return replace_items(field_map, dict((key, field) for key, field in items.items()
+                                         if key in names))
+
+
+def requested_names(arg, allowed):
+    """The names listed in the ``arg`` query parameter, or ``None``.
+    Unknown names are rejected with 400.
+    """
+    names = [name.strip() for name in request.args.get(arg, '').split(',') if name.strip()]
+    if not names:
+        return None
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        abort(400, {"message" : "Unknown {}: {}.".format(arg, ', '.join(unknown))})
+    return frozenset(names)
+
+
+class serialize_with(object):
+    """Drop-in replacement for ``marshal_with`` using a compiled field map.
+    Responses returned by the resource are passed through untouched.
+
+    A ``?fields=`` sparse fieldset restricts the items to those fields, and
+    ``?include=`` adds the matching ``include`` fields to them. Both are
+    validated before the resource runs and left in ``g.sparse_fields`` and
+    ``g.includes``, for ``paginate`` to narrow the SELECT list and ``embed``
+    to load the children.
+    """
+
+    def __init__(self, fields, include=None):
+        self.fields = fields
+        self.include = include or {}
+        self.serialize = compile_fields(fields)
+        self.variants = {}
+
+    def variant(self, names, includes):
+        key = (names, includes)
+        serialize = self.variants.get(key)
+        if serialize is None:
+            field_map = self.fields if names is None else project(self.fields, names)
+            if includes:
+                items = dict(item_fields(field_map))
+                items.update((name, field) for name, field in self.include.items()
+                             if name in includes)
+                field_map = replace_items(field_map, items)
+            serialize = self.variants[key] = compile_fields(field_map)
+        return serialize
+
+    def __call__(self, f):
+        allowed = item_fields(self.fields)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            names = g.sparse_fields = requested_names('fields', allowed)
+            includes = g.includes = requested_names('include', self.include)
+            resp = f(*args, **kwargs)
+            if isinstance(resp, Response):
+                return resp
+            data, code, headers = unpack(resp)
+            if names is None and includes is None:
+                serialize = self.serialize
+            else:
+                serialize = self.variant(names, includes)
+            return serialize(data), code, headers
+        return wrapper
+
+
+def output_json(data, code, headers=None):
+    """JSON representation of the API, encoded with orjson when
+    ``JSON_SERIALIZER`` is ``'orjson'`` and it is installed.
+
+    orjson writes compact UTF-8 rather than the stdlib's spaced, ASCII-escaped
+    output, so it is opt-in, and debug mode keeps the indented stdlib output.
+    """
+    if (orjson is None or current_app.config.get('JSON_SERIALIZER') != 'orjson'
+            or current_app.debug or current_app.config.get('RESTFUL_JSON')):
+        return restful_output_json(data, code, headers)
+    resp = make_response(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE), code)
+    resp.headers.extend(headers or {})
+    return resp
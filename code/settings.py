@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import tempfile
 
 
 class Config(object):
@@ -11,26 +12,195 @@ class Config(object):
     ERROR_404_HELP = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Directory for the SQLite stores shared by the workers of one host,
+    # created with mode 0700; it must not be writable by other users
+    RUNTIME_DIR = os.getenv('RUNTIME_DIR',
+                            os.path.join(tempfile.gettempdir(), 'recipes-api-{}'.format(os.getuid())))
+
     SECRET_KEY = os.getenv('SECRET_KEY', 'xoi82SJuX98#*$aIAjakj3sus')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'postgresql:///recipesdemo')
+    # PostgreSQL connection pool: connections kept open and extra ones
+    # allowed under load, seconds to wait for one and before reopening one,
+    # and whether to test each connection as it is checked out
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    # Milliseconds a statement may run before the server cancels it (0 for no limit)
+    DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+    # Connections opened when a worker creates the app
+    DB_POOL_WARM = int(os.getenv('DB_POOL_WARM', 0))
+    # Read replicas for the GET endpoints marked with @read_from_replica, as
+    # a comma separated list of database URLs. Set DB_READ_FROM_REPLICAS to
+    # false to send every query to the primary.
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if uri]
+    DB_READ_FROM_REPLICAS = os.getenv('DB_READ_FROM_REPLICAS', 'true').lower() in ('1', 'true')
+    # Seconds a user's reads stay on the primary after they write, recorded
+    # per worker ('memory') or in a file shared by the workers of one host ('sqlite')
+    DB_REPLICA_STICKY_SECONDS = 5
+    DB_REPLICA_STICKY_BACKEND = os.getenv('DB_REPLICA_STICKY_BACKEND', 'sqlite')
+    DB_REPLICA_STICKY_PATH = os.getenv('DB_REPLICA_STICKY_PATH',
+                                       os.path.join(RUNTIME_DIR, 'replica-writers.sqlite'))
+    # Most recent writers remembered, in either store
+    DB_REPLICA_STICKY_MAX_ENTRIES = 100000
     MAIL_SERVER=os.getenv('MAIL_SERVER')
-    MAIL_PORT=465
-    MAIL_USE_SSL=True
-    MAIL_USE_TLS=False
+    MAIL_PORT=int(os.getenv('MAIL_PORT', 465))
+    MAIL_USE_SSL=os.getenv('MAIL_USE_SSL', 'true').lower() in ('1', 'true')
+    MAIL_USE_TLS=os.getenv('MAIL_USE_TLS', '').lower() in ('1', 'true')
     MAIL_USERNAME=os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD=os.getenv('MAIL_PASSWORD')
+    # Who drains the outbox: 'thread' in every app process, or 'none' when
+    # `flask mail worker` runs separately
+    MAIL_QUEUE_WORKER = os.getenv('MAIL_QUEUE_WORKER', 'thread')
+    # Messages sent per SMTP connection, and seconds between outbox polls
+    MAIL_QUEUE_BATCH_SIZE = 50
+    MAIL_QUEUE_POLL_SECONDS = 30
+    # Attempts per message, the first retry waiting MAIL_RETRY_BACKOFF
+    # seconds and each next one twice as long
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_BACKOFF = 30
+
+    # Whether category and recipe titles are unique regardless of case. This
+    # shapes the unique indexes, so it is read when the tables are created
+    # or migrated; changing it needs the indexes rebuilt.
+    UNIQUE_TITLES_IGNORE_CASE = os.getenv('UNIQUE_TITLES_IGNORE_CASE', '').lower() in ('1', 'true')
+
+    # Password hashing: werkzeug method with its cost, salt length, and the
+    # processes per worker that run it (0 hashes inline). Hashes made with
+    # other parameters are upgraded on the next sign in.
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    PASSWORD_SALT_LENGTH = 16
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    # Seconds to wait for a hash from the pool
+    PASSWORD_HASH_TIMEOUT = 30
+
+    # Token buckets per endpoint, as (requests, seconds) per client address
+    # ('ip') and per email or username in the body ('account')
+    RATE_LIMITS = {
+        'api.usersigninresource': { 'ip': (20, 60), 'account': (5, 60) },
+        'api.usercollectionresource': { 'ip': (10, 3600) },
+        'api.usersendrecoveryresource': { 'ip': (5, 3600), 'account': (3, 3600) },
+        'api.userpasswordresetresource': { 'ip': (10, 3600) },
+    }
+    # Where buckets live: 'sqlite' for a file shared by the workers of one
+    # host, 'memory' per worker (multiplying the limits by the number of
+    # workers), or 'none'
+    RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'sqlite')
+    RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH',
+                                os.path.join(RUNTIME_DIR, 'rate-limits.sqlite'))
+    # Proxies in front of the app whose X-Forwarded-For and
+    # X-Forwarded-Proto are trusted: 0 when clients connect directly, as
+    # otherwise they could pick the address rate limits key on
+    PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', 0))
+    PROXY_FIX_X_PROTO = int(os.getenv('PROXY_FIX_X_PROTO', 0))
+
+    # Largest number of items accepted by the batch create endpoints
+    BATCH_MAX_ITEMS = 1000
+
+    # Set to 'orjson' to encode API responses with orjson when it is
+    # installed. Its output is compact, so it is not byte-identical to the
+    # default encoder.
+    JSON_SERIALIZER = os.getenv('JSON_SERIALIZER', 'json')
+
+    # Records read, validated and staged at a time by the importer
+    IMPORT_CHUNK_SIZE = 5000
+
+    # Seconds between incremental reloads of the banned token cache
+    REVOCATION_REFRESH_SECONDS = 30
+    # Seconds behind the last seen ban or credential change re-read on each
+    # refresh, covering transactions that commit out of order
+    REVOCATION_REFRESH_OVERLAP = 60
+    # Let GET requests trust the token claims instead of loading the user
+    AUTH_STATELESS = False
+
+    # Total count strategy ('exact', 'cached' or 'estimated') per endpoint,
+    # overriding the resource's default
+    PAGINATION_COUNT = {}
+    # Lifetime and size of the cache behind the 'cached' strategy
+    PAGINATION_COUNT_TTL = 60
+    PAGINATION_COUNT_CACHE_SIZE = 1024
+
+    # Default and largest number of children embedded per item with ?include=
+    INCLUDE_LIMIT = 10
+    INCLUDE_MAX_LIMIT = 50
+
+    # Store for encoded collection pages: 'sqlite' for a file shared by the
+    # workers of one host, 'memory' per worker, or 'none'. Per worker, a
+    # user's next page can come from a worker that missed their write.
+    RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'sqlite')
+    RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH',
+                                    os.path.join(RUNTIME_DIR, 'response-cache.sqlite'))
+    # Lifetime and size of the response cache
+    RESPONSE_CACHE_TTL = 30
+    RESPONSE_CACHE_SIZE = 512
+
+    # Content codings in order of preference; br and zstd need the brotli
+    # and zstandard packages
+    COMPRESS_ALGORITHMS = ('br', 'zstd', 'gzip')
+    # Smallest body worth compressing, in bytes (streams are always compressed)
+    COMPRESS_MIN_SIZE = 500
+    # Level per coding, and overrides per endpoint,
+    # e.g. {'api.exportresource': {'gzip': 1}}
+    COMPRESS_LEVELS = { 'gzip': 6, 'br': 4, 'zstd': 3 }
+    COMPRESS_ROUTE_LEVELS = {}
+
+    # Request metrics served at METRICS_PATH in the Prometheus text format.
+    # Each worker writes its counters to a file in METRICS_DIR every
+    # METRICS_FLUSH_SECONDS; gunicorn.conf.py empties it when the service starts.
+    METRICS_ENABLED = True
+    METRICS_PATH = '/metrics'
+    METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(RUNTIME_DIR, 'metrics'))
+    METRICS_FLUSH_SECONDS = 5
+    # Bearer token required to read the metrics, if set. The metrics name
+    # every endpoint, so without a token they are only served in development.
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    METRICS_REQUIRE_TOKEN = True
+
+    # Count the SQL statements of each request, reported in X-Query-Count
+    # and X-Query-Duplicates headers
+    QUERY_BUDGET_ENABLED = False
+    # Largest number of statements per request, per endpoint or per endpoint
+    # and method. Collection GETs cover their search (?q=) too. Batch and
+    # bulk budgets hold up to BATCH_MAX_ITEMS items, and the import budget
+    # covers one IMPORT_CHUNK_SIZE chunk of records; larger imports run the
+    # same statements again for every further chunk.
+    QUERY_BUDGETS = {
+        'api.categorycollectionresource': { 'GET': 6, 'POST': 6, 'PATCH': 2, 'DELETE': 4 },
+        'api.categoryresource': { 'GET': 3, 'PUT': 4, 'DELETE': 5 },
+        'api.categorybatchresource': { 'POST': 4 },
+        'api.recipecollectionresource': { 'GET': 4, 'POST': 4, 'PATCH': 3, 'DELETE': 4 },
+        'api.reciperesource': { 'GET': 2, 'PUT': 4, 'DELETE': 3 },
+        'api.recipebatchresource': { 'POST': 5 },
+        'api.exportresource': { 'GET': 2 },
+        'api.importresource': { 'POST': 6 },
+        'api.usercollectionresource': { 'GET': 2, 'POST': 2 },
+        'api.usersigninresource': 3,
+    }
+    # Raise QueryBudgetExceeded instead of warning when a budget is exceeded
+    QUERY_BUDGET_STRICT = False
+    # Write a summary of the statements per endpoint to stderr at exit
+    QUERY_BUDGET_REPORT = False
 
 
 class ProdConfig(Config):
     """Production configuration."""
     ENV = 'prod'
     DEBUG = False
+    DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 30000))
+    DB_POOL_WARM = int(os.getenv('DB_POOL_WARM', 2))
+    # Behind the Heroku router
+    PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', 1))
+    PROXY_FIX_X_PROTO = int(os.getenv('PROXY_FIX_X_PROTO', 1))
 
 
 class DevConfig(Config):
     """Development configuration."""
     ENV = 'dev'
     DEBUG = True
+    QUERY_BUDGET_ENABLED = True
+    QUERY_BUDGET_REPORT = os.getenv('QUERY_BUDGET_REPORT', '').lower() in ('1', 'true')
+    METRICS_REQUIRE_TOKEN = False
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'postgresql:///recipesdemo')
 
 
@@ -40,3 +210,9 @@ class TestConfig(Config):
     TESTING = True
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = 'postgresql:///recipesdemotest'
+    QUERY_BUDGET_ENABLED = True
+    QUERY_BUDGET_STRICT = True
+    METRICS_REQUIRE_TOKEN = False
+    # Cheap hashes, computed inline
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
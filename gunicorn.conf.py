@@ -0,0 +1,10 @@
+"""Gunicorn settings, read from the working directory by the Procfile's
+gunicorn command.
+"""
+from code import DefaultConfig
+from code.metrics import clear_metrics
+
+
+def on_starting(server):
+    # Counters left by the workers of the previous run would be summed forever
+    clear_metrics(DefaultConfig.METRICS_DIR)
@@ -0,0 +1,41 @@
+"""Full-text search indexes on categories and recipes
+
+Revision ID: 3f1c2a9b7d4e
+Revises: 5d2e8f1a9c3b
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d4e'
+down_revision = '5d2e8f1a9c3b'
+branch_labels = None
+depends_on = None
+
+# Same expressions as the indexes create_search_index declares
+SEARCH_INDEXES = {
+    'categories': "to_tsvector('english', title || ' ' || description)",
+    'recipes': "to_tsvector('english', title || ' ' || description)",
+}
+
+
+def upgrade():
+    context = op.get_context()
+    if context.dialect.name != 'postgresql':
+        return
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction, and does
+    # not block writes while the index is built
+    with context.autocommit_block():
+        for table, document in SEARCH_INDEXES.items():
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{0}_search '
+                       'ON {0} USING gin ({1})'.format(table, document))
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        for table in SEARCH_INDEXES:
+            op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_{}_search'.format(table))
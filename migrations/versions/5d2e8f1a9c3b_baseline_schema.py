@@ -0,0 +1,77 @@
+"""Users, categories, recipes and revoked tokens
+
+Revision ID: 5d2e8f1a9c3b
+Revises:
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8f1a9c3b'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases set up before the migrations were committed already have
+    # these tables; leave them as they are
+    context = op.get_context()
+    existing = set() if context.as_sql else set(sa.inspect(op.get_bind()).get_table_names())
+    if 'users' not in existing:
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('username', sa.String(length=100), nullable=False),
+            sa.Column('email', sa.String(length=256), nullable=False),
+            sa.Column('password_hash', sa.String(length=256), nullable=False),
+            sa.Column('first_name', sa.String(length=50), nullable=True),
+            sa.Column('last_name', sa.String(length=50), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('modified_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('email'),
+        )
+    if 'tokens' not in existing:
+        op.create_table(
+            'tokens',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('token', sa.String(length=500), nullable=False),
+            sa.Column('banned_on', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('token'),
+        )
+    if 'categories' not in existing:
+        op.create_table(
+            'categories',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=100), nullable=False),
+            sa.Column('description', sa.String(length=255), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('modified_at', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+    if 'recipes' not in existing:
+        op.create_table(
+            'recipes',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('category_id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=100), nullable=False),
+            sa.Column('description', sa.String(length=255), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('modified_at', sa.DateTime(), nullable=False),
+            sa.ForeignKeyConstraint(['category_id'], ['categories.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+
+def downgrade():
+    op.drop_table('recipes')
+    op.drop_table('categories')
+    op.drop_table('tokens')
+    op.drop_table('users')
@@ -0,0 +1,27 @@
+"""Credential version of users
+
+Revision ID: 8b4d1e7c2f60
+Revises: 3f1c2a9b7d4e
+Create Date: 2026-10-18 10:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4d1e7c2f60'
+down_revision = '3f1c2a9b7d4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing users start at version 0, which their tokens carry implicitly
+    op.add_column('users', sa.Column('credential_version', sa.Integer(), nullable=False,
+                                     server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('credential_version')
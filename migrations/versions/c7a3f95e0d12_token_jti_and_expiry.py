@@ -0,0 +1,60 @@
+"""Revoked tokens keyed by jti, with their expiry
+
+Revision ID: c7a3f95e0d12
+Revises: 8b4d1e7c2f60
+Create Date: 2026-10-18 10:20:00.000000
+
+"""
+import datetime
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a3f95e0d12'
+down_revision = '8b4d1e7c2f60'
+branch_labels = None
+depends_on = None
+
+# Longest lifetime of the auth tokens revoked before this revision
+TOKEN_LIFETIME = datetime.timedelta(days=2)
+
+
+def upgrade():
+    op.add_column('tokens', sa.Column('jti', sa.String(length=32), nullable=True))
+    op.add_column('tokens', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    # Tokens revoked so far were issued without a jti: key them by the
+    # digest Token.key_for uses for those, and let them expire no later
+    # than their lifetime after the revocation
+    connection = op.get_bind()
+    tokens = sa.table('tokens', sa.column('id', sa.Integer), sa.column('token', sa.String),
+                      sa.column('banned_on', sa.DateTime), sa.column('jti', sa.String),
+                      sa.column('expires_at', sa.DateTime))
+    for id, token, banned_on in connection.execute(
+            sa.select([tokens.c.id, tokens.c.token, tokens.c.banned_on])).fetchall():
+        connection.execute(tokens.update().where(tokens.c.id == id).values(
+            jti=hashlib.sha256(token.encode('utf-8')).hexdigest()[:32],
+            expires_at=banned_on + TOKEN_LIFETIME))
+    with op.batch_alter_table('tokens') as batch_op:
+        batch_op.alter_column('jti', existing_type=sa.String(length=32), nullable=False)
+        batch_op.alter_column('expires_at', existing_type=sa.DateTime(), nullable=False)
+        batch_op.create_unique_constraint('tokens_jti_key', ['jti'])
+        batch_op.drop_column('token')
+    op.create_index('ix_tokens_banned_on', 'tokens', ['banned_on'])
+    # Used by Token.purge_expired
+    op.create_index('ix_tokens_expires_at', 'tokens', ['expires_at'])
+
+
+def downgrade():
+    # The full tokens are gone; revocations cannot be carried back
+    op.drop_index('ix_tokens_expires_at', 'tokens')
+    op.drop_index('ix_tokens_banned_on', 'tokens')
+    op.execute('DELETE FROM tokens')
+    with op.batch_alter_table('tokens') as batch_op:
+        batch_op.add_column(sa.Column('token', sa.String(length=500), nullable=False))
+        batch_op.create_unique_constraint('tokens_token_key', ['token'])
+        batch_op.drop_constraint('tokens_jti_key', type_='unique')
+        batch_op.drop_column('expires_at')
+        batch_op.drop_column('jti')
@@ -0,0 +1,41 @@
+"""Outbox of email waiting for the mail worker
+
+Revision ID: e41b6c8d3a57
+Revises: c7a3f95e0d12
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41b6c8d3a57'
+down_revision = 'c7a3f95e0d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('subject', sa.String(length=255), nullable=False),
+        sa.Column('sender', sa.String(length=256), nullable=False),
+        sa.Column('recipients', sa.Text(), nullable=False),
+        sa.Column('html', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # Used by OutboxMessage.claim_due
+    op.create_index('ix_outbox_next_attempt_at', 'outbox', ['next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_outbox_next_attempt_at', 'outbox')
+    op.drop_table('outbox')
@@ -0,0 +1,43 @@
+"""Unique category and recipe titles per owner
+
+Revision ID: f2d9a0b4c6e1
+Revises: e41b6c8d3a57
+Create Date: 2026-10-18 10:40:00.000000
+
+"""
+from alembic import op
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2d9a0b4c6e1'
+down_revision = 'e41b6c8d3a57'
+branch_labels = None
+depends_on = None
+
+# Same indexes as unique_per_owner declares, by table: (name, owner column)
+UNIQUE_INDEXES = {
+    'categories': ('uq_categories_user_id_title', 'user_id'),
+    'recipes': ('uq_recipes_category_id_title', 'category_id'),
+}
+
+
+def upgrade():
+    # Shaped by the app's config, as in configure_indexes
+    title = 'lower(title)' if current_app.config.get('UNIQUE_TITLES_IGNORE_CASE') else 'title'
+    context = op.get_context()
+    if context.dialect.name != 'postgresql':
+        for table, (name, owner) in UNIQUE_INDEXES.items():
+            op.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0} ON {1} ({2}, {3})'.format(
+                name, table, owner, title))
+        return
+    # Built without blocking writes; fails if titles are already duplicated
+    with context.autocommit_block():
+        for table, (name, owner) in UNIQUE_INDEXES.items():
+            op.execute('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {0} ON {1} ({2}, {3})'.format(
+                name, table, owner, title))
+
+
+def downgrade():
+    for table, (name, owner) in UNIQUE_INDEXES.items():
+        op.drop_index(name, table)
@@ -1,5 +1,16 @@
 import json
+import datetime
+import smtplib
+import threading
+from unittest import mock
+from flask_mail import Connection
 from tests.base_test_case import BaseTestCase
+from code import create_app, db, register_proxy_fix
+from code.mailer import mailer
+from code.models.token import Token
+from code.models.user import User
+from code.models.outbox import OutboxMessage
+from code.passwords import passwords
 
 class AuthTestCases(BaseTestCase):
     """
@@ -17,6 +28,23 @@ class AuthTestCases(BaseTestCase):
                                     content_type='application/json')
         self.assertEqual(response.status_code, 200)
 
+    def test_get_users_estimated_total(self):
+        """
+            A test for totals taken from the planner's row estimate
+            The url endpoint is;
+                =>    /api/users (get)
+        """
+        with self.app.app_context():
+            dialect = db.engine.dialect
+        with mock.patch.object(dialect, 'name', 'postgresql'), \
+                mock.patch('code.helpers.planner_estimate', return_value=42) as estimate:
+            response = self.tester.get('/api/users')
+        self.assertEqual(response.status_code, 200)
+        meta = json.loads(response.data.decode())['meta']
+        self.assertEqual(meta['total'], 42)
+        self.assertFalse(meta['exact'])
+        self.assertTrue(estimate.called)
+
     def test_create_new_user(self):
         """ 
             A test for creating new users
@@ -165,7 +193,260 @@ class AuthTestCases(BaseTestCase):
         response = self.tester.get("/api/users/signout",
                                     headers=dict(Authorization='Bearer ' + self.token))
         self.assertEqual(response.status_code, 401)
-    
+
+    def test_access_with_banned_token(self):
+        """
+            A test for accessing a protected resource with a banned token
+            The url endpoint is;
+                =>    /api/users/id (get)
+        """
+        self.test_signout_user_with_auth()
+        response = self.tester.get("/api/users/{}".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 401)
+
+    def test_refresh_picks_up_late_commits(self):
+        """
+            A test for reading bans that commit after a later stamped one
+        """
+        from code.revocation import revocations, token_digest
+        self.test_signout_user_with_auth()
+        with self.app.app_context():
+            revocations.refresh(force=True)
+            state = self.app.extensions['revocations']
+            expires_at = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+            late = Token('late-commit', expires_at)
+            late.banned_on = state.watermark - datetime.timedelta(seconds=5)
+            late.save()
+            revocations.refresh(force=True)
+            self.assertIn(token_digest('late-commit'), state.digests)
+
+    def test_refresh_picks_up_late_version_changes(self):
+        """
+            A test for reading credential changes that commit after a later
+            stamped one
+        """
+        from code.revocation import revocations
+        with self.app.app_context():
+            revocations.refresh(force=True)
+            state = self.app.extensions['revocations']
+            user = User.get_by_id(self.user_id)
+            user.credential_version += 1
+            user.modified_at = state.user_watermark - datetime.timedelta(seconds=5)
+            user.save()
+            revocations.refresh(force=True)
+            self.assertEqual(state.versions.get(self.user_id), 1)
+
+    def test_stateless_token_after_password_change(self):
+        """
+            A test for the stateless auth path rejecting tokens issued
+            before a password change
+            The url endpoint is;
+                =>    /api/users/id/categories/id (get)
+        """
+        self.app.config['AUTH_STATELESS'] = True
+        url = "/api/users/{}/categories/{}".format(self.user_id, self.category_id)
+        response = self.tester.get(url, headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.put("/api/users/{}".format(self.user_id),
+                                    data=json.dumps(dict({ "password": "newstarwars" })),
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.get(url, headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 401)
+
+    def test_signout_keeps_other_sessions(self):
+        """
+            A test for signing out one session while another stays signed in
+            The url endpoint is;
+                =>    /api/users/signout (get)
+        """
+        response = self.tester.post("/api/users/signin",
+                                    data=self.login_data,
+                                    content_type="application/json")
+        other_token = json.loads(response.data.decode())['token']
+        response = self.tester.get("/api/users/signout",
+                                    headers=dict(Authorization='Bearer ' + other_token))
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.get("/api/users/{}".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.get("/api/users/{}".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + other_token))
+        self.assertEqual(response.status_code, 401)
+
+    def test_stateless_token_after_user_deleted_by_another_worker(self):
+        """
+            A test for the stateless auth path of another worker rejecting
+            the tokens of a deleted user
+            The url endpoint is;
+                =>    /api/users/id/categories (get)
+        """
+        from code.revocation import revocations
+        self.app.config['AUTH_STATELESS'] = True
+        other = create_app()
+        other.config['AUTH_STATELESS'] = True
+        url = "/api/users/{}/categories".format(self.user_id)
+        headers = dict(Authorization='Bearer ' + self.token)
+        self.assertEqual(other.test_client().get(url, headers=headers).status_code, 200)
+        response = self.tester.delete("/api/users/{}".format(self.user_id), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        with other.app_context():
+            revocations.refresh(force=True)
+        self.assertEqual(other.test_client().get(url, headers=headers).status_code, 401)
+
+    def test_purge_expired_tokens(self):
+        """
+            A test for purging revocations of expired tokens
+        """
+        self.test_signout_user_with_auth()
+        with self.app.app_context():
+            self.assertEqual(Token.purge_expired(), 0)
+            later = datetime.datetime.utcnow() + datetime.timedelta(days=3)
+            self.assertEqual(Token.purge_expired(now=later), 1)
+
+    def test_signin_upgrades_password_hash(self):
+        """
+            A test for rehashing a password with new parameters on sign in
+            The url endpoint is;
+                =>    /api/users/signin (post)
+        """
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        response = self.tester.post("/api/users/signin",
+                                    data=self.login_data,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            user = User.get_by_id(self.user_id)
+            self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+            self.assertEqual(user.credential_version, 0)
+        response = self.tester.get("/api/users/{}".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.post("/api/users/signin",
+                                    data=self.login_data,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+    def test_signin_password_hash_timeout(self):
+        """
+            A test for answering 503 when the password hashing pool does not
+            return a hash in time
+            The url endpoint is;
+                =>    /api/users/signin (post)
+        """
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        future = mock.Mock()
+        future.result.side_effect = TimeoutError
+        pool = mock.Mock()
+        pool.submit.return_value = future
+        with mock.patch.object(passwords, '_executor',
+                               return_value=(pool, threading.BoundedSemaphore(1))):
+            response = self.tester.post("/api/users/signin",
+                                        data=self.login_data,
+                                        content_type="application/json")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'],
+                         str(self.app.config['PASSWORD_HASH_TIMEOUT']))
+
+    def test_signin_rate_limited(self):
+        """
+            A test for throttling sign ins to one account
+            The url endpoint is;
+                =>    /api/users/signin (post)
+        """
+        self.app.config['RATE_LIMITS'] = { 'api.usersigninresource': { 'account': (2, 60) } }
+        for _ in range(2):
+            response = self.tester.post("/api/users/signin",
+                                        data=self.login_data,
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+        response = self.tester.post("/api/users/signin",
+                                    data=self.login_data,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(0 < int(response.headers['Retry-After']) <= 30)
+
+    def test_signup_rate_limited_per_forwarded_address(self):
+        """
+            A test for throttling sign ups per client address, as forwarded
+            by the proxy in front of the app
+            The url endpoint is;
+                =>    /api/users (post)
+        """
+        self.app.config['RATE_LIMITS'] = { 'api.usercollectionresource': { 'ip': (1, 3600) } }
+        self.app.config['PROXY_FIX_X_FOR'] = 1
+        register_proxy_fix(self.app)
+        for address, status in (('10.0.0.1', 400), ('10.0.0.2', 400), ('10.0.0.1', 429)):
+            response = self.tester.post("/api/users",
+                                        data=json.dumps(dict({ "username" : "Jumai" })),
+                                        headers={ 'X-Forwarded-For': address },
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, status)
+
+    def test_signup_rate_limit_ignores_untrusted_forwarded_address(self):
+        """
+            A test for keying sign up limits on the peer address when no
+            proxy is trusted, whatever X-Forwarded-For claims
+            The url endpoint is;
+                =>    /api/users (post)
+        """
+        self.app.config['RATE_LIMITS'] = { 'api.usercollectionresource': { 'ip': (1, 3600) } }
+        for address, status in (('10.0.0.1', 400), ('10.0.0.2', 429)):
+            response = self.tester.post("/api/users",
+                                        data=json.dumps(dict({ "username" : "Jumai" })),
+                                        headers={ 'X-Forwarded-For': address },
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, status)
+
+    def test_send_recovery_email(self):
+        """
+            A test for queueing a recovery email and sending it from the outbox
+            The url endpoint is;
+                =>    /api/users/recovery (post)
+        """
+        self.app.config['MAIL_QUEUE_WORKER'] = 'none'
+        self.app.extensions['mail'].suppress = True
+        response = self.tester.post("/api/users/recovery",
+                                    data=json.dumps(dict({ "email": "jumai@gmail.com" })),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        with self.app.app_context():
+            self.assertEqual(OutboxMessage.query.filter_by(status='pending').count(), 1)
+        with self.app.extensions['mail'].record_messages() as outbox:
+            result = self.app.test_cli_runner().invoke(args=['mail', 'drain'])
+        self.assertIn("Sent 1 message(s)", result.output)
+        self.assertEqual(outbox[0].recipients, ["jumai@gmail.com"])
+        with self.app.app_context():
+            self.assertEqual(OutboxMessage.query.filter_by(status='sent').count(), 1)
+
+    def test_drain_outbox_past_a_refused_recipient(self):
+        """
+            A test for sending the rest of a batch when the server refuses
+            one message's recipient
+        """
+        self.app.config['MAIL_QUEUE_WORKER'] = 'none'
+        self.app.extensions['mail'].suppress = True
+        with self.app.app_context():
+            for email in ("amina@gmail.com", "refused@gmail.com", "baraka@gmail.com"):
+                mailer.enqueue("Hello", "recipes@gmail.com", [email], "<p>Hello</p>")
+        sent = []
+
+        def send(message):
+            if message.recipients == ["refused@gmail.com"]:
+                raise smtplib.SMTPRecipientsRefused({ "refused@gmail.com": (550, b"No such user") })
+            sent.extend(message.recipients)
+
+        with mock.patch.object(Connection, 'send', side_effect=send):
+            with self.app.app_context():
+                self.assertEqual(mailer.drain(), (2, 1))
+        self.assertEqual(sent, ["amina@gmail.com", "baraka@gmail.com"])
+        with self.app.app_context():
+            refused = OutboxMessage.query.filter_by(recipients="refused@gmail.com").one()
+            self.assertEqual((refused.status, refused.attempts), ('pending', 1))
+            self.assertEqual(OutboxMessage.query.filter_by(status='sent').count(), 2)
+
     def test_get_a_404_page(self):
         """
             A test to get a 404 page when the url does not exist
@@ -20,6 +20,13 @@ class BaseTestCase(unittest.TestCase):
         """
         # Application setup
         self.app = create_app()
+        # Fail requests running more SQL statements than their budget
+        self.app.config['QUERY_BUDGET_STRICT'] = True
+        # The response cache file outlives the app; start from an empty one
+        if self.app.extensions['response_cache'] is not None:
+            self.app.extensions['response_cache'].clear()
+        if self.app.extensions['rate_limits'] is not None:
+            self.app.extensions['rate_limits'].clear()
 
         # Database setup
         with self.app.app_context():
@@ -1,5 +1,19 @@
+import gzip
 import json
+import os
+import tempfile
+from unittest import mock
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import upgrade
+from flask_restful import marshal
 from tests.base_test_case import BaseTestCase
+from code.api.category import category_collection_fields
+from code.models.category import Category
+from code.models.recipe import Recipe
+from code.serializers import compile_fields
+from code.settings import DevConfig
+from code import create_app, db
 
 class CategoryTestCases(BaseTestCase):
     """
@@ -57,9 +71,9 @@ class CategoryTestCases(BaseTestCase):
                                     content_type="application/json")
         self.assertEqual(response.status_code, 200)
 
-    def test_update_category_with_existing_title(self):
+    def test_update_category_keeping_title(self):
         """
-            A test for updating categories with a title that already exists
+            A test for updating a category without changing its title
             The url endpoint is;
                 =>    /api/users/{user_id}/categories/{category_id} (put)
         """
@@ -72,9 +86,55 @@ class CategoryTestCases(BaseTestCase):
                                     data=existing_category_data,
                                     headers=dict(Authorization='Bearer ' + self.token),
                                     content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+    
+    def test_update_category_with_other_category_title(self):
+        """
+            A test for renaming a category to the title of another category
+            The url endpoint is;
+                =>    /api/users/{user_id}/categories/{category_id} (put)
+        """
+        self.test_create_new_category()
+        other_category_data = json.dumps(dict({
+            "title": "Chinese",
+            "description": "Dishes Made in China"
+        }))
+        response = self.tester.put("/api/users/{}/categories/{}".format(self.user_id, self.category_id),
+                                    data=other_category_data,
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/json")
         self.assertEqual(response.status_code, 409)
         self.assertIn("Category already exists", str(response.data))
-    
+
+    def test_create_category_title_ignoring_case(self):
+        """
+            A test for category titles unique regardless of case
+            The url endpoint is;
+                =>    /api/users/{user_id}/categories (post)
+        """
+        with mock.patch.object(DevConfig, 'UNIQUE_TITLES_IGNORE_CASE', True):
+            self.setUp()
+        response = self.tester.post("/api/users/{}/categories".format(self.user_id),
+                                    data=json.dumps(dict(title="KENYAN", description="Loud")),
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertIn("Category already exists", str(response.data))
+
+    def test_migrations_match_models(self):
+        """
+            A test for building the schema from the migrations alone, with
+            nothing left for autogenerate to add or drop
+        """
+        class MigratedConfig(DevConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'migrated.sqlite')
+        app = create_app(MigratedConfig)
+        with app.app_context():
+            upgrade(directory=os.path.join(os.path.dirname(__file__), '..', 'migrations'))
+            with db.engine.connect() as connection:
+                changes = compare_metadata(MigrationContext.configure(connection), db.metadata)
+        self.assertEqual(changes, [])
+
     def test_get_category_by_id(self):
         """
             A test for getting categories by id
@@ -97,6 +157,31 @@ class CategoryTestCases(BaseTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Dishes Made in Kenya", str(response.data))
     
+    def test_get_categories_with_recipes(self):
+        """
+            A test for getting categories with their recipes embedded
+            The url endpoint is;
+                =>    /api/users/id/categories?include=recipes (get)
+        """
+        headers = dict(Authorization='Bearer ' + self.token)
+        self.tester.post("/api/categories/{}/recipes".format(self.category_id),
+                         data=json.dumps(dict({ "category_id": self.category_id, "title": "ugali",
+                                                "description": "Maize meal" })),
+                         headers=headers, content_type="application/json")
+        url = "/api/users/{}/categories".format(self.user_id)
+        response = self.tester.get(url + "?include=recipes&recipes_limit=1", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.data.decode())['items']
+        self.assertEqual([recipe['title'] for recipe in items[0]['recipes']], ["uji"])
+        response = self.tester.get("{}/{}?include=recipes&fields=title".format(url, self.category_id),
+                                    headers=headers)
+        category = json.loads(response.data.decode())
+        self.assertEqual(sorted(category), ["recipes", "title"])
+        self.assertEqual(len(category['recipes']), 2)
+        response = self.tester.get(url + "?include=users", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Unknown include: users.", str(response.data))
+
     def test_delete_category_by_id(self):
         """
             A test for deleting categories by id
@@ -108,5 +193,192 @@ class CategoryTestCases(BaseTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn("Delete", str(response.data))
 
+    def test_delete_categories_by_ids(self):
+        """
+            A test for deleting many categories with their recipes
+            The url endpoint is;
+                =>    /api/users/id/categories?ids= (delete)
+        """
+        self.test_create_new_category()
+        response = self.tester.delete("/api/users/{}/categories?ids={}".format(self.user_id, self.category_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode())['count'], 1)
+        response = self.tester.get("/api/users/{}/categories".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        res = json.loads(response.data.decode())
+        self.assertEqual([item['title'] for item in res['items']], ["Chinese"])
+
+    def test_delete_categories_notifies_after_commit(self):
+        """
+            A test for announcing the deletion of categories and their
+            recipes only once it is committed
+        """
+        calls = mock.Mock()
+        with self.app.app_context():
+            query = Category.query.filter_by(id=self.category_id)
+            with mock.patch('code.database.notify_change', calls.notify_change), \
+                    mock.patch.object(db.session, 'commit', calls.commit):
+                Category.bulk_delete(query, owner=self.user_id)
+        self.assertEqual(calls.mock_calls, [
+            mock.call.commit(),
+            mock.call.notify_change(Category, self.user_id),
+            mock.call.notify_change(Recipe, self.category_id),
+        ])
+
+    def test_update_categories_by_title(self):
+        """
+            A test for updating the categories matching a title filter
+            The url endpoint is;
+                =>    /api/users/id/categories?title= (patch)
+        """
+        response = self.tester.patch("/api/users/{}/categories?title=ken".format(self.user_id),
+                                    data=json.dumps(dict({ "description": "Dishes from Kenya" })),
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode())['count'], 1)
+        response = self.tester.get("/api/users/{}/categories/{}".format(self.user_id, self.category_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertIn("Dishes from Kenya", str(response.data))
+
+    def test_update_categories_with_invalid_description(self):
+        """
+            A test for rejecting bulk updates with a bad description
+            The url endpoint is;
+                =>    /api/users/id/categories?title= (patch)
+        """
+        url = "/api/users/{}/categories?title=ken".format(self.user_id)
+        for description in (42, "x" * 1000):
+            response = self.tester.patch(url, data=json.dumps(dict({ "description": description })),
+                                        headers=dict(Authorization='Bearer ' + self.token),
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+    def test_export_categories(self):
+        """
+            A test for exporting categories with their recipes
+            The url endpoint is;
+                =>    /api/users/id/export (get)
+        """
+        response = self.tester.get("/api/users/{}/export".format(self.user_id),
+                                    headers=dict(Authorization='Bearer ' + self.token))
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]['title'], "Kenyan")
+        self.assertEqual([recipe['title'] for recipe in lines[0]['recipes']], ["uji"])
+        response = self.tester.get("/api/users/{}/export".format(self.user_id),
+                                    headers={ 'Authorization': 'Bearer ' + self.token,
+                                              'Accept-Encoding': 'gzip' })
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data).decode().splitlines()[0],
+                         json.dumps(lines[0]))
+
+    def test_export_query_budget_counts_streamed_statements(self):
+        """
+            A test for counting the statements run while streaming an export
+            against its budget
+            The url endpoint is;
+                =>    /api/users/id/export (get)
+        """
+        self.app.config['QUERY_BUDGETS'] = { 'api.exportresource': 1 }
+        with self.assertLogs('code.querybudget', 'WARNING') as logs:
+            response = self.tester.get("/api/users/{}/export".format(self.user_id),
+                                        headers=dict(Authorization='Bearer ' + self.token))
+            self.assertEqual(len(response.data.decode().splitlines()), 1)
+            response.close()
+        self.assertIn('ran 2 SQL statements, over its budget of 1 while streaming', logs.output[0])
+
+    def test_import_categories(self):
+        """
+            A test for importing categories with their recipes
+            The url endpoint is;
+                =>    /api/users/id/import (post)
+        """
+        lines = [
+            { "title": "Kenyan", "description": "Merged", "recipes": [
+                { "title": "uji", "description": "Skipped" },
+                { "title": "ugali", "description": "Maize meal" }] },
+            { "title": "Indian", "description": "Spicy", "recipes": [] },
+            { "title": "", "description": "Rejected" },
+        ]
+        response = self.tester.post("/api/users/{}/import".format(self.user_id),
+                                    data="\n".join(json.dumps(line) for line in lines),
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.data.decode())
+        self.assertEqual(report, { "categories": 1, "recipes": 1, "rejected": 1 })
+        csv_data = "title,description,recipe_title,recipe_description\nIndian,Spicy,dal,Lentils\n"
+        response = self.tester.post("/api/users/{}/import".format(self.user_id),
+                                    data=csv_data,
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="text/csv")
+        report = json.loads(response.data.decode())
+        self.assertEqual(report, { "categories": 0, "recipes": 1, "rejected": 0 })
+
+    def test_large_import_within_budget(self):
+        """
+            A test for an import of more than a hundred lines running the
+            same statements as a small one
+            The url endpoint is;
+                =>    /api/users/id/import (post)
+        """
+        lines = [{ "title": "Category {}".format(index), "description": "Many", "recipes": [
+                    { "title": "Recipe {}".format(index), "description": "Many" }] }
+                 for index in range(250)]
+        response = self.tester.post("/api/users/{}/import".format(self.user_id),
+                                    data="\n".join(json.dumps(line) for line in lines),
+                                    headers=dict(Authorization='Bearer ' + self.token),
+                                    content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        report = json.loads(response.data.decode())
+        self.assertEqual(report, { "categories": 250, "recipes": 250, "rejected": 0 })
+        self.assertLessEqual(int(response.headers['X-Query-Count']),
+                             self.app.config['QUERY_BUDGETS']['api.importresource']['POST'])
+
+    def test_serializer_matches_marshal(self):
+        """
+            A test for the compiled serializer producing the same JSON as marshal
+        """
+        with self.app.app_context():
+            data = { 'items': Category.query.all(),
+                     'meta': { 'page': 1, 'limit': 3, 'total': None, 'links': {} } }
+            expected = json.dumps(marshal(data, category_collection_fields))
+            serialize = compile_fields(category_collection_fields)
+            self.assertEqual(json.dumps(serialize(data)), expected)
+
+    def test_get_categories_from_replica(self):
+        """
+            A test for reading categories from a replica until the user
+            writes
+            The url endpoint is;
+                =>    /api/users/id/categories (get)
+        """
+        class ReplicaConfig(DevConfig):
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + os.path.join(
+                tempfile.gettempdir(), 'recipes-replica-test.sqlite')]
+            DB_REPLICA_STICKY_BACKEND = 'memory'
+        app = create_app(ReplicaConfig)
+        with app.app_context():
+            # An empty replica, lagging behind the primary
+            replica = db.get_replicas()[0]
+            db.Model.metadata.drop_all(replica)
+            db.Model.metadata.create_all(replica)
+        tester = app.test_client()
+        url = "/api/users/{}/categories".format(self.user_id)
+        headers = dict(Authorization='Bearer ' + self.token)
+        response = tester.get(url, headers=headers)
+        self.assertEqual(json.loads(response.data.decode())['meta']['total'], 0)
+        # Replica reads are not cached, so they last no longer than the lag
+        response = tester.get(url, headers=headers)
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        response = tester.post(url, headers=headers, content_type="application/json",
+                               data=json.dumps(dict(title="Ethiopian", description="Injera")))
+        self.assertEqual(response.status_code, 201)
+        response = tester.get(url, headers=headers)
+        self.assertEqual(json.loads(response.data.decode())['meta']['total'], 2)
+
 if __name__ == "__main__":
     unittest.main()